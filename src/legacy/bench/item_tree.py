@@ -0,0 +1,117 @@
+import sys
+import time
+import random
+from pathlib import Path
+from docopt import docopt
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from py.calc_item_tree import calc_item_tree
+
+__doc__ = """
+
+Benchmark calc_item_tree on synthetic items
+
+Checks that the output matches a straightforward reference implementation
+on sites small enough for the reference to finish, then times
+calc_item_tree alone on larger sites.
+
+Usage:
+  item_tree.py [--items=N] [--tags=N] [--max-tags-per-item=N] [--seed=N]
+
+Options:
+  --items=N               Number of items in the largest site [default: 5000]
+  --tags=N                Number of distinct tags in the largest site [default: 300]
+  --max-tags-per-item=N   Maximum number of tags on one item [default: 4]
+  --seed=N                Random seed [default: 0]
+
+"""
+
+
+def reference_item_tree(items):
+  # The original implementation of calc_item_tree, kept to check against
+
+  def strict_superset(li0, li1):
+    return len(li0) > len(li1) and all(x in li0 for x in li1)
+
+  def without(li, x):
+    li_ = li[:]
+    li_.remove(x)
+    return li_
+
+  def aux(tag, tags, universe):
+    def items_with(tag):
+      return [item for item in items if tag in item['tags']]
+
+    rose = sorted(
+      [item for item in items if set(item['tags']) == set(tags)],
+      key=lambda item: item['title']
+    )
+
+    children = []
+    for child_tag in universe:
+      nonempty = any(set(item['tags']) >= {*tags, child_tag} for item in items)
+      subset = any(
+        strict_superset(items_with(tag), items_with(child_tag))
+        for tag in universe
+      )
+      if nonempty and not subset:
+        children.append(aux(child_tag, tags + [child_tag], without(universe, child_tag)))
+
+    return {"tag": tag, "items": rose, "children": children}
+
+  tags = sorted(set(tag for item in items for tag in item['tags']))
+  return [aux(None, [], tags)]
+
+
+def synthetic_items(rng, *, n_items, n_tags, max_tags_per_item):
+  """
+  Generate items whose tags follow a skewed distribution,
+  so that some tags are common and some are rare
+  """
+  tags = [f"tag{i}" for i in range(n_tags)]
+  weights = [1 / (i + 1) for i in range(n_tags)]
+  items = []
+  for i in range(n_items):
+    n = rng.randint(0, min(max_tags_per_item, n_tags))
+    item_tags = list(dict.fromkeys(rng.choices(tags, weights=weights, k=n)))
+    # titles are not unique, to exercise the stability of sorting
+    items.append({
+      'title': f"Item {rng.randint(0, n_items // 2)}",
+      'tags': item_tags,
+      'location': f"items/{i}.fm",
+    })
+  return items
+
+
+def timed(f, *args):
+  start = time.perf_counter()
+  result = f(*args)
+  return result, time.perf_counter() - start
+
+
+def main():
+  args = docopt(__doc__)
+  rng = random.Random(int(args['--seed']))
+  n_items = int(args['--items'])
+  n_tags = int(args['--tags'])
+  max_tags = int(args['--max-tags-per-item'])
+
+  print("Checking against reference implementation")
+  for small_items, small_tags in [(10, 5), (50, 12), (150, 20)]:
+    items = synthetic_items(rng, n_items=small_items, n_tags=small_tags, max_tags_per_item=max_tags)
+    expected, ref_time = timed(reference_item_tree, items)
+    actual, new_time = timed(calc_item_tree, items)
+    if actual != expected:
+      sys.exit(f"  MISMATCH with {small_items} items and {small_tags} tags")
+    print(f"  {small_items:>6} items {small_tags:>4} tags: reference {ref_time:.3f}s, calc_item_tree {new_time:.4f}s")
+
+  print("Timing calc_item_tree")
+  sizes = sorted({(n_items // 10, n_tags // 10), (n_items // 3, n_tags // 3), (n_items, n_tags)})
+  for size_items, size_tags in sizes:
+    items = synthetic_items(rng, n_items=size_items, n_tags=size_tags, max_tags_per_item=max_tags)
+    _, elapsed = timed(calc_item_tree, items)
+    print(f"  {size_items:>6} items {size_tags:>4} tags: {elapsed:.3f}s")
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,184 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import contextlib
+import importlib.util
+from pathlib import Path
+from docopt import docopt
+
+from synth import legacy_dir, generate_site, edit_one_item, install_fake_tools
+
+__doc__ = """
+
+Benchmark the build pipeline on a synthetic site
+
+Generates a site with the given number of items in a temporary directory,
+then times each phase of the build, and whole builds in three modes:
+  cold  from scratch, with an empty build/, artifact store and caches
+  warm  again, with nothing changed
+  edit  again, after editing the body of one markdown item
+pdflatex, bibtex and sass are replaced by stubs so that this runs offline.
+
+Usage:
+  pipeline.py [--items=N] [--tags=N] [--payload-size=BYTES] [--repeat=N] [--jobs=N] [--seed=N] [--output=FILE]
+
+Options:
+  --items=N             Number of items [default: 500]
+  --tags=N              Number of distinct tags [default: 50]
+  --payload-size=BYTES  Average payload size [default: 4000]
+  --repeat=N            Take the best of N runs of each measurement [default: 3]
+  --jobs=N              Passed on to the builds [default: 1]
+  --seed=N              Random seed [default: 0]
+  --output=FILE         Write the results as JSON to FILE
+
+"""
+
+
+def load_site_module():
+  # site.py can't be imported by name since it would clash with the standard library's 'site'
+  spec = importlib.util.spec_from_file_location('site_py', legacy_dir / 'site.py')
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+
+def best_of(repeat, f, *, setup=None):
+  """ Best wall time of `repeat` runs of f, with its output silenced """
+  times = []
+  for _ in range(repeat):
+    if setup is not None:
+      setup()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+      start = time.perf_counter()
+      f()
+      times.append(time.perf_counter() - start)
+  return min(times)
+
+
+def main():
+  args = docopt(__doc__)
+  config = {
+    'items': int(args['--items']),
+    'tags': int(args['--tags']),
+    'payload_size': int(args['--payload-size']),
+    'repeat': int(args['--repeat']),
+    'jobs': int(args['--jobs']),
+    'seed': int(args['--seed']),
+  }
+  repeat = config['repeat']
+  jobs = config['jobs']
+
+  root = Path(tempfile.mkdtemp(prefix='site-bench-'))
+  try:
+    install_fake_tools(root / 'bin')
+    generate_site(
+      root,
+      n_items=config['items'],
+      n_tags=config['tags'],
+      payload_size=config['payload_size'],
+      seed=config['seed'],
+    )
+
+    # The build modules find src/ and build/ relative to the working directory.
+    # The artifact store is kept here too, so that a shared one neither
+    # makes cold builds warm nor fills up with synthetic items
+    os.chdir(root)
+    os.environ['SITE_ARTIFACT_STORE'] = str(root / '.artifacts')
+    sys.path.insert(0, str(legacy_dir))
+    site = load_site_module()
+    import py.build
+    from py.globals import build_target, parse_cache_f, cache_dir, artifact_store_dir
+    from py.parse import parse_item
+    from py.cache import BuildCache
+    from py.build import build_payloads
+    from py.calc_item_tree import calc_item_tree, calc_tree_shape
+
+    results = {}
+
+    def clear_code_caches():
+      # Rendered markdown and compiled unplate code and templates, on disk and in memory
+      shutil.rmtree(cache_dir, ignore_errors=True)
+      py.build.markdown_html_cache.clear()
+      py.build.unplate_code_cache.clear()
+      py.build.loaded_templates.update(key=None, module=None)
+
+    def from_scratch():
+      if build_target.exists():
+        shutil.rmtree(build_target)
+      shutil.rmtree(artifact_store_dir, ignore_errors=True)
+      clear_code_caches()
+
+    # Whole builds
+    results['build_site.cold'] = best_of(
+      repeat,
+      lambda: site.build_site(from_scratch=False, jobs=jobs),
+      setup=from_scratch,
+    )
+    results['build_site.warm'] = best_of(
+      repeat,
+      lambda: site.build_site(from_scratch=False, jobs=jobs),
+    )
+    edit_seed = iter(range(repeat))
+    results['build_site.edit'] = best_of(
+      repeat,
+      lambda: site.build_site(from_scratch=False, jobs=jobs),
+      setup=lambda: edit_one_item(root, seed=next(edit_seed)),
+    )
+
+    # Phases, on the build directory left by the builds above
+    fm_files = sorted(build_target.glob('**/*.fm'))
+
+    def clear_parse_cache():
+      if parse_cache_f.exists():
+        parse_cache_f.unlink()
+
+    results['find_items.cold'] = best_of(
+      repeat,
+      lambda: site.find_items(build_target),
+      setup=clear_parse_cache,
+    )
+    results['find_items.warm'] = best_of(repeat, lambda: site.find_items(build_target))
+    results['parse_item'] = best_of(repeat, lambda: [parse_item(path) for path in fm_files])
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+      items = site.find_items(build_target)
+    indexed = [item for item in items if item['indexed']]
+    results['calc_item_tree'] = best_of(
+      repeat,
+      lambda: calc_item_tree(indexed),
+      setup=calc_tree_shape.cache_clear,
+    )
+
+    scratch_cache_f = root / 'bench_build_cache.json'
+
+    def clear_build_cache():
+      if scratch_cache_f.exists():
+        scratch_cache_f.unlink()
+      clear_code_caches()
+
+    def run_build_payloads():
+      cache = BuildCache(scratch_cache_f)
+      build_payloads(items, cache=cache, jobs=jobs)
+      cache.save()
+
+    results['build_payloads.cold'] = best_of(repeat, run_build_payloads, setup=clear_build_cache)
+    results['build_payloads.warm'] = best_of(repeat, run_build_payloads)
+
+  finally:
+    os.chdir(legacy_dir)
+    shutil.rmtree(root, ignore_errors=True)
+
+  width = max(map(len, results))
+  for name, seconds in results.items():
+    print(f"{name:<{width}}  {seconds:8.4f}s")
+
+  if args['--output']:
+    with open(args['--output'], 'w') as f:
+      json.dump({'config': config, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,80 @@
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+from pathlib import Path
+from docopt import docopt
+
+from synth import legacy_dir, generate_site, install_fake_tools
+
+__doc__ = """
+
+Benchmark how quickly site.py commands start and finish when there is nothing to do
+
+Generates a site with the given number of items in a temporary directory,
+builds it once, then times fresh runs of:
+  python      the Python interpreter alone, for reference
+  unindexed   site.py unindexed
+  build       site.py build, with nothing changed since the last build
+Each run is a separate process, so this includes the cost of imports.
+pdflatex, bibtex and sass are replaced by stubs so that this runs offline.
+
+Usage:
+  startup.py [--items=N] [--repeat=N] [--output=FILE]
+
+Options:
+  --items=N      Number of items [default: 200]
+  --repeat=N     Take the best of N runs of each command [default: 5]
+  --output=FILE  Write the results as JSON to FILE
+
+"""
+
+
+def best_of(repeat, command, *, cwd):
+  """ Best wall time of `repeat` runs of a command """
+  times = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    subprocess.run(command, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    times.append(time.perf_counter() - start)
+  return min(times)
+
+
+def main():
+  args = docopt(__doc__)
+  config = {
+    'items': int(args['--items']),
+    'repeat': int(args['--repeat']),
+  }
+  repeat = config['repeat']
+
+  root = Path(tempfile.mkdtemp(prefix='site-bench-'))
+  try:
+    install_fake_tools(root / 'bin')
+    generate_site(root, n_items=config['items'], n_tags=config['items'] // 10 + 1)
+
+    site = [sys.executable, str(legacy_dir / 'site.py')]
+    subprocess.run(site + ['build'], cwd=root, stdout=subprocess.DEVNULL, check=True)
+
+    results = {
+      'python': best_of(repeat, [sys.executable, '-c', 'pass'], cwd=root),
+      'unindexed': best_of(repeat, site + ['unindexed'], cwd=root),
+      'build': best_of(repeat, site + ['build'], cwd=root),
+    }
+
+  finally:
+    shutil.rmtree(root, ignore_errors=True)
+
+  width = max(map(len, results))
+  for name, seconds in results.items():
+    print(f"{name:<{width}}  {seconds:8.4f}s")
+
+  if args['--output']:
+    with open(args['--output'], 'w') as f:
+      json.dump({'config': config, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,148 @@
+"""
+Generation of synthetic sites for benchmarking the build pipeline.
+
+A synthetic site is a directory containing a src/ tree shaped like the
+real one: an index, a templates.py, and a number of items under
+src/items/ with varied tags, payload sizes and build chains.
+"""
+
+import os
+import random
+import shutil
+from pathlib import Path
+
+legacy_dir = Path(__file__).resolve().parent.parent
+
+# Build chains to choose from, with relative weights
+chains = [
+  (8, 'markdown >> template("post") >> write', 'md'),
+  (3, 'template("post", requires=["mathjax", "notes"]) >> write', 'html'),
+  (2, 'unplate >> markdown >> template("post", requires=["mathjax"]) >> write', 'md'),
+  (1, 'latex("{name}.tex")', 'tex'),
+]
+
+words = (
+  "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor "
+  "incididunt ut labore et dolore magna aliqua enim ad minim veniam quis nostrud"
+).split()
+
+
+def paragraph(rng, n_words):
+  return ' '.join(rng.choice(words) for _ in range(n_words)).capitalize() + '.'
+
+
+def payload(rng, kind, size):
+  """ A payload of roughly `size` bytes in the given format """
+  paragraphs = []
+  while sum(map(len, paragraphs)) < size:
+    paragraphs.append(paragraph(rng, rng.randint(20, 80)))
+
+  if kind == 'md':
+    return '\n\n'.join(
+      f"## {p[:30]}\n\n{p}" if i % 4 == 0 else p
+      for i, p in enumerate(paragraphs)
+    )
+  if kind == 'html':
+    return '\n'.join(f"<p>{p}</p>" for p in paragraphs)
+  return ''
+
+
+def generate_site(root: Path, *, n_items, n_tags, max_tags_per_item=4, payload_size=4000, seed=0):
+  """ Write a synthetic site into root/src/, replacing anything already there """
+  rng = random.Random(seed)
+  src = root / 'src'
+  if src.exists():
+    shutil.rmtree(src)
+  (src / 'items').mkdir(parents=True)
+
+  shutil.copy(legacy_dir / 'src' / 'templates.py', src / 'templates.py')
+  shutil.copy(legacy_dir / 'src' / 'index.jinja2.fm', src / 'index.jinja2.fm')
+
+  tags = [f"tag{i}" for i in range(n_tags)]
+  # A skewed distribution, so that some tags are common and some rare
+  tag_weights = [1 / (i + 1) for i in range(n_tags)]
+  chain_weights = [weight for weight, _, _ in chains]
+
+  for i in range(n_items):
+    name = f"item{i}"
+    _, chain, kind = rng.choices(chains, weights=chain_weights)[0]
+    item_tags = list(dict.fromkeys(rng.choices(tags, weights=tag_weights, k=rng.randint(0, max_tags_per_item))))
+    size = int(payload_size * rng.uniform(0.25, 2))
+
+    if kind == 'tex':
+      item_dir = src / 'items' / name
+      item_dir.mkdir()
+      (item_dir / f"{name}.tex").write_text(
+        "\\documentclass{article}\n\\begin{document}\n"
+        + paragraph(rng, size // 6)
+        + "\n\\end{document}\n"
+      )
+      fm_file = item_dir / f"{name}.txt.fm"
+      extra = f"target: {name}.pdf\nfiles: [.]\n"
+      body = ''
+    else:
+      fm_file = src / 'items' / f"{name}.html.fm"
+      extra = ''
+      body = payload(rng, kind, size)
+
+    fm_file.write_text(
+      "---\n"
+      f"title: Item {i}\n"
+      f"tags: [{', '.join(item_tags)}]\n"
+      f"build: '{chain.format(name=name)}'\n"
+      f"description: {paragraph(rng, 10)}\n"
+      f"{extra}"
+      "---\n"
+      f"{body}\n"
+    )
+
+
+def edit_one_item(root: Path, *, seed=0):
+  """ Append to the body of one markdown item, as when editing a post """
+  rng = random.Random(seed)
+  candidates = sorted(
+    path for path in (root / 'src' / 'items').glob('*.html.fm')
+    if 'markdown' in path.read_text().split('---')[1]
+  )
+  path = rng.choice(candidates)
+  with open(path, 'a') as f:
+    f.write('\n\n' + paragraph(rng, 40) + '\n')
+  return path
+
+
+fake_tools = {
+  # Writes the files a real pdflatex run would, without typesetting anything
+  'pdflatex': '''#!/bin/sh
+[ "$1" = --version ] && { echo 'pdfTeX stub'; exit 0; }
+for arg; do tex="$arg"; done
+name=$(basename "$tex" .tex)
+echo '\\\\relax' > "$name.aux"
+printf 'PWD %s\\nINPUT %s\\n' "$PWD" "$tex" > "$name.fls"
+echo '%PDF-1.4' > "$name.pdf"
+''',
+  'bibtex': '''#!/bin/sh
+echo "bibtex stub"
+''',
+  # Writes an empty stylesheet for each source:target pair
+  'sass': '''#!/bin/sh
+for arg; do
+  case "$arg" in
+    -*) ;;
+    *) : > "${arg#*:}" ;;
+  esac
+done
+''',
+}
+
+
+def install_fake_tools(bin_dir: Path):
+  """
+  Write stand-ins for pdflatex, bibtex and sass into bin_dir and put it
+  first on PATH, so that benchmarks run offline and measure our own code
+  """
+  bin_dir.mkdir(parents=True, exist_ok=True)
+  for name, script in fake_tools.items():
+    path = bin_dir / name
+    path.write_text(script)
+    path.chmod(0o755)
+  os.environ['PATH'] = f"{bin_dir}{os.pathsep}{os.environ['PATH']}"
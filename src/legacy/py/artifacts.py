@@ -0,0 +1,149 @@
+import os
+import re
+import json
+import time
+import shutil
+import functools
+import threading
+from pathlib import Path
+
+from .globals import artifact_store_dir
+from .sync import copy_file
+
+_units = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+def parse_size(text):
+  """ Parse a size such as '500M' or '2G' to a number of bytes """
+  match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*', text, re.I)
+  if not match:
+    raise ValueError(f"Not a size: {text!r}")
+  return int(float(match.group(1)) * _units[match.group(2).upper()])
+
+def format_size(size):
+  for unit in ['', 'K', 'M', 'G']:
+    if size < 1024 or unit == 'G':
+      return f"{size:.1f}{unit}B" if unit else f"{size}B"
+    size /= 1024
+
+class ArtifactStore:
+  """
+  Content-addressed store of expensive build outputs, such as LaTeX PDFs.
+
+  Each artifact is a set of files stored under a key which is a digest of
+  everything that went into making them. The store is a plain directory
+  which may be shared between clones and builds; entries are only ever
+  added whole (by renaming a complete directory into place) or removed
+  whole, so concurrent users see either all of an entry or none of it.
+
+  Entries are evicted least recently used first; using an entry touches
+  its directory.
+  """
+
+  def __init__(self, path: Path):
+    self.path = path
+    self.objects = path / 'objects'
+    self.tmp = path / 'tmp'
+    # Number of entries added by this process since it last pruned
+    self.added = 0
+
+  def entry_dir(self, key):
+    return self.objects / key[:2] / key
+
+  def get(self, key):
+    """ The metadata and directory of the entry with the given key, or None """
+    entry = self.entry_dir(key)
+    try:
+      with open(entry / 'meta.json', 'r') as f:
+        meta = json.load(f)
+    except (FileNotFoundError, ValueError):
+      return None
+    try:
+      os.utime(entry)
+    except OSError:
+      pass
+    return meta, entry / 'files'
+
+  def put(self, key, files, meta):
+    """
+    Store files, given as a map from relative names to paths, under a key,
+    along with JSON-able metadata. Does nothing if the key is already stored.
+    """
+    entry = self.entry_dir(key)
+    if entry.exists():
+      return
+
+    self.tmp.mkdir(parents=True, exist_ok=True)
+    staging = self.tmp / f'{key}.{os.getpid()}.{threading.get_ident()}'
+    try:
+      staging.mkdir()
+      size = 0
+      for rel, path in files.items():
+        target = staging / 'files' / rel
+        target.parent.mkdir(parents=True, exist_ok=True)
+        copy_file(path, target)
+        size += target.stat().st_size
+      with open(staging / 'meta.json', 'w') as f:
+        json.dump({**meta, 'key': key, 'files': sorted(files), 'size': size, 'created': time.time()}, f, indent=1)
+
+      entry.parent.mkdir(parents=True, exist_ok=True)
+      try:
+        os.rename(staging, entry)
+        self.added += 1
+      except OSError:
+        # Someone else stored it first
+        pass
+    finally:
+      shutil.rmtree(staging, ignore_errors=True)
+
+  def entries(self):
+    """ (last used time, size, directory) of each entry, least recently used first """
+    result = []
+    if not self.objects.is_dir():
+      return result
+    for shard in os.scandir(self.objects):
+      if not shard.is_dir():
+        continue
+      for entry in os.scandir(shard.path):
+        try:
+          with open(os.path.join(entry.path, 'meta.json'), 'r') as f:
+            size = json.load(f)['size']
+          used = entry.stat().st_mtime
+        except (OSError, ValueError, KeyError):
+          continue
+        result.append((used, size, Path(entry.path)))
+    return sorted(result)
+
+  def stats(self):
+    entries = self.entries()
+    return {
+      'entries': len(entries),
+      'size': sum(size for _, size, _ in entries),
+      'oldest_use': entries[0][0] if entries else None,
+      'newest_use': entries[-1][0] if entries else None,
+    }
+
+  def prune(self, max_size):
+    """ Evict least recently used entries until the store is at most max_size bytes. Returns (entries, bytes) removed. """
+    self.added = 0
+    entries = self.entries()
+    total = sum(size for _, size, _ in entries)
+    removed = removed_size = 0
+    for _, size, entry in entries:
+      if total <= max_size:
+        break
+      # Moved aside first, so that nobody sees a partially deleted entry
+      self.tmp.mkdir(parents=True, exist_ok=True)
+      doomed = self.tmp / f'evict.{entry.name}.{os.getpid()}.{threading.get_ident()}'
+      try:
+        os.rename(entry, doomed)
+      except OSError:
+        continue
+      shutil.rmtree(doomed, ignore_errors=True)
+      total -= size
+      removed += 1
+      removed_size += size
+    return removed, removed_size
+
+@functools.lru_cache(maxsize=None)
+def default_store():
+  return ArtifactStore(artifact_store_dir)
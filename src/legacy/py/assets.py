@@ -0,0 +1,140 @@
+import os
+import re
+import gzip
+import json
+import hashlib
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from .globals import internal_files
+from . import output
+from .minify import minify
+from .images import pillow
+from .scan import default_ignore, scan_files
+
+# Map from the URLs of site-wide assets to their content-hashed URLs,
+# when optimizing; see asset_url and site.py's --optimize
+asset_map = {}
+
+# Site-wide assets live in this directory of the build
+assets_dir_name = 'assets'
+
+# Kinds of site-wide asset that are given content-hashed names
+fingerprinted_suffixes = ['.css', '.js', '.ico']
+
+# Matches the stem of a file named by fingerprint_assets, e.g. 'global.0123456789'
+fingerprinted_stem = re.compile(r'.+\.[0-9a-f]{10}')
+
+# Kinds of file that are given precompressed siblings, and the smallest
+# size worth compressing. Other files, like PDFs and images, are already compressed.
+compressible_suffixes = ['.html', '.css', '.js', '.svg', '.json', '.txt', '.xml']
+min_compress_size = 256
+
+
+def asset_url(url):
+  """ The URL to link to a site-wide asset by; this is content-hashed when optimizing """
+  return asset_map.get(url, url)
+
+
+def optimization_key():
+  """ Identifies how pages are currently optimized, for digests of anything that is built into a page """
+  image_settings = pillow() if output.responsive_images else None
+  return json.dumps([output.minify_outputs, image_settings, sorted(asset_map.items())])
+
+
+def fingerprint_assets(directory: Path, *, enabled=True):
+  """
+  Give each site-wide asset a minified copy named after a hash of its
+  contents, e.g. assets/css/global.css -> assets/css/global.0123456789.css,
+  so that these can be cached forever. Returns the map from original
+  URLs to the new ones.
+  Copies made for earlier versions of the assets are removed, as are
+  all of them if not enabled.
+  """
+  urls = {}
+  existing = set()
+  current = set()
+
+  for path in scan_files(directory / assets_dir_name, suffix='', ignore=default_ignore):
+    if path.suffix not in fingerprinted_suffixes:
+      continue
+    if fingerprinted_stem.fullmatch(path.stem):
+      existing.add(path)
+      continue
+    if not enabled:
+      continue
+
+    data = path.read_bytes()
+    if path.suffix in ['.css', '.js']:
+      data = minify(path.suffix, data.decode()).encode()
+    digest = hashlib.sha256(data).hexdigest()[:10]
+    hashed = path.with_name(f'{path.stem}.{digest}{path.suffix}')
+    output.write_output(hashed, data)
+    current.add(hashed)
+    urls['/' + path.relative_to(directory).as_posix()] = '/' + hashed.relative_to(directory).as_posix()
+
+  for path in existing - current:
+    path.unlink()
+
+  return urls
+
+
+def compressors():
+  """ Map from sibling suffix to compression function, for each available compression """
+  result = {'.gz': lambda data: gzip.compress(data, compresslevel=9, mtime=0)}
+  try:
+    import brotli
+  except ImportError:
+    pass
+  else:
+    result['.br'] = lambda data: brotli.compress(data, quality=11)
+  return result
+
+
+def precompress(directory: Path, *, enabled=True):
+  """
+  Write .gz siblings, and .br siblings if the brotli package is
+  installed, of the compressible files in directory, for servers to send
+  to clients that accept them.
+  Each sibling is given the mtime of its file, so only files that changed
+  since they were last compressed are compressed again. Siblings of files
+  that no longer exist are removed, as are all of them if not enabled.
+  Returns the number of siblings written.
+  """
+  encodings = compressors() if enabled else {}
+  all_suffixes = ['.gz', '.br']
+
+  sources = []
+  siblings = set()
+  for path in scan_files(directory, suffix='', ignore=default_ignore + internal_files):
+    if path.suffix in all_suffixes and Path(path.stem).suffix in compressible_suffixes:
+      siblings.add(path)
+    elif path.suffix in compressible_suffixes:
+      sources.append(path)
+
+  tasks = []
+  wanted = set()
+  for source in sources:
+    stat = source.stat()
+    if stat.st_size < min_compress_size:
+      continue
+    for suffix, compress in encodings.items():
+      sibling = source.with_name(source.name + suffix)
+      wanted.add(sibling)
+      if sibling in siblings and sibling.stat().st_mtime_ns == stat.st_mtime_ns:
+        continue
+      tasks.append((source, stat, sibling, compress))
+
+  def run(task):
+    source, stat, sibling, compress = task
+    output.write_output(sibling, compress(source.read_bytes()))
+    os.utime(sibling, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+  # zlib and brotli release the GIL while compressing
+  with ThreadPoolExecutor() as pool:
+    list(pool.map(run, tasks))
+
+  for path in siblings - wanted:
+    path.unlink()
+
+  return len(tasks)
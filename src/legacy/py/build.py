@@ -1,36 +1,125 @@
-import unplate as unplate_module
+import sys
+import json
+import types
+import marshal
+import functools
+import hashlib
+import threading
+import traceback
 from pathlib import Path
-from markdown import markdown as parse_markdown
-from .globals import build_target
+from concurrent.futures import ThreadPoolExecutor
+from .globals import build_target, build_source, cache_dir
 from .calc_item_tree import calc_item_tree
-from .log import log_section, log
-from .util import shell_exec, was_modified, flatten
+from .log import log_section, log, buffered, in_context, count, error
+from .latex import compile_latex
+from .output import write_output
+from .images import responsive_images, default_widths as default_image_widths
+from .tags import tag_href
+from . import profile
+from . import assets
+from .context import TrackedContext, ContextFingerprints, code_names
+from .util import shell_exec, hash_paths, flatten
+
+class BuildError(Exception):
+  pass
 
 class composable:
   """
   Allow a function to be composed with >> such that
   (f >> g)(x) = g(f(x))
+  A composed function keeps track of its individual stages
+  so that each can be profiled separately.
   """
-  def __init__(self, f):
+  def __init__(self, f, name=None):
     self.f = f
+    self.name = name or f.__name__
+    self.stages = [self]
+
+  def named(self, name):
+    self.name = name
+    return self
 
-  def __call__(self, *args, **kwargs):
-    return self.f(*args, **kwargs)
+  def __call__(self, item, ctx):
+    for stage in self.stages:
+      item = profile.run_stage(stage.name, stage.f, item, ctx)
+    return item
 
   def __rshift__(self, other):
-    def composed(item, ctx):
-      return other.f(self.f(item, ctx), ctx)
-    return composable(composed)
+    composed = composable(None, name=f"{self.name} >> {other.name}")
+    composed.stages = self.stages + other.stages
+    return composed
+
+# Heavy dependencies (markdown, unplate) are imported by the builders
+# that use them, so that commands which build nothing start quickly
+
+# Passed to markdown.Markdown
+markdown_extensions = []
+markdown_extension_configs = {}
+
+markdown_cache_dir = cache_dir / 'markdown'
+markdown_html_cache = {}
+markdown_html_cache_lock = threading.Lock()
+markdown_local = threading.local()
+
+@functools.lru_cache(maxsize=None)
+def markdown_cache_salt():
+  """ Rendered HTML depends on the source, the version of markdown, and its configuration """
+  return '\0'.join([
+    package_version('markdown'),
+    json.dumps([markdown_extensions, markdown_extension_configs], sort_keys=True, default=str),
+  ])
+
+def markdown_converter():
+  """
+  This thread's markdown converter. Converters are expensive to set up
+  but not thread-safe, so each thread makes one and reuses it.
+  """
+  converter = getattr(markdown_local, 'converter', None)
+  if converter is None:
+    import markdown as markdown_module
+    converter = markdown_local.converter = markdown_module.Markdown(
+      extensions=markdown_extensions,
+      extension_configs=markdown_extension_configs,
+    )
+  return converter
+
+def render_markdown(source):
+  """
+  Render markdown to HTML.
+  Results are cached by source hash, both in memory and on disk.
+  """
+  key = hashlib.sha256((markdown_cache_salt() + '\0' + source).encode()).hexdigest()
+
+  with markdown_html_cache_lock:
+    if key in markdown_html_cache:
+      profile.cache_hit()
+      return markdown_html_cache[key]
+
+  cache_f = markdown_cache_dir / f'{key}.html'
+  try:
+    with open(cache_f, 'r') as f:
+      html = f.read()
+    profile.cache_hit()
+  except FileNotFoundError:
+    html = markdown_converter().reset().convert(source)
+    markdown_cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp_f = cache_f.with_suffix(f'.{threading.get_ident()}.tmp')
+    with open(tmp_f, 'w') as f:
+      f.write(html)
+    tmp_f.replace(cache_f)
+
+  with markdown_html_cache_lock:
+    markdown_html_cache[key] = html
+  return html
 
 @composable
 def markdown(item, ctx):
-  item['payload'] = parse_markdown(item['payload'])
+  item['payload'] = render_markdown(item['payload'])
   return item
 
 @composable
 def write(item, ctx):
-  with open(item['target'], 'w') as out:
-    out.write(item['payload'])
+  write_output(item['target'], item['payload'])
   return item
 
 def write_to(location):
@@ -38,17 +127,16 @@ def write_to(location):
 
   @composable
   def builder(item, ctx):
-    with open(location, 'w') as out:
-      out.write(item['payload'])
+    write_output(location, item['payload'])
     return item
-  return builder
+  return builder.named('write_to')
 
 def shell(shell_cmd):
   @composable
   def builder(item, ctx):
     shell_exec(shell_cmd)
     return item
-  return builder
+  return builder.named('shell')
 
 @composable
 def noop(item, ctx):
@@ -56,31 +144,103 @@ def noop(item, ctx):
   return item
 
 
-unplate_options = unplate_module.options.Options()
-unplate_options.interpolation_open = '[|'
-unplate_options.interpolation_close = '|]'
+def package_version(name):
+  import importlib.metadata
+  try:
+    return importlib.metadata.version(name)
+  except importlib.metadata.PackageNotFoundError:
+    return ''
+
+@functools.lru_cache(maxsize=None)
+def unplate_settings():
+  """ The unplate options for payloads, and the salt for caches of code compiled by unplate """
+  import unplate as unplate_module
+  options = unplate_module.options.Options()
+  options.interpolation_open = '[|'
+  options.interpolation_close = '|]'
+  # Compiled code depends on the versions of unplate and
+  # Python (as marshal's format is version-specific)
+  salt = '\0'.join([
+    package_version('unplate'),
+    sys.version,
+    options.interpolation_open,
+    options.interpolation_close,
+  ])
+  return options, salt
+
+unplate_cache_dir = cache_dir / 'unplate'
+unplate_code_cache = {}
+unplate_code_cache_lock = threading.Lock()
+
+def compile_unplate(payload):
+  """
+  Compile an unplate payload to a code object which, when run, sets 'template___'.
+  Compiled code is cached by payload hash, both in memory and on disk.
+  """
+  unplate_options, salt = unplate_settings()
+  key = hashlib.sha256((salt + '\0' + payload).encode()).hexdigest()
+
+  with unplate_code_cache_lock:
+    if key in unplate_code_cache:
+      profile.cache_hit()
+      return unplate_code_cache[key]
+
+  cache_f = unplate_cache_dir / f'{key}.marshal'
+  try:
+    with open(cache_f, 'rb') as f:
+      compiled = marshal.load(f)
+    profile.cache_hit()
+  except (FileNotFoundError, EOFError, ValueError, TypeError):
+    # because unplate requires the exact tokens '[unplate.template(' in
+    # order to work, we can't write '[unplate_module.template(', so
+    # we need to import it under that name
+    # TODO: this is gonna act funny if the payload contains a triple-quote
+    import unplate
+    # add three underscores after 'template' to reduce change of namespace
+    # conflict with the payload code
+    code = f"""
+[unplate.begin(template___)] @ '''
+{ payload }
+''' [unplate.end]
+  """
+    compiled = compile(unplate.compile_anon(code, options=unplate_options), '<unplate>', 'exec')
+
+    unplate_cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp_f = cache_f.with_suffix(f'.{threading.get_ident()}.tmp')
+    with open(tmp_f, 'wb') as f:
+      marshal.dump(compiled, f)
+    tmp_f.replace(cache_f)
+
+  with unplate_code_cache_lock:
+    unplate_code_cache[key] = compiled
+  return compiled
 
 @composable
 def unplate(item, ctx):
+  compiled = compile_unplate(item['payload'])
 
-  # because unplate requires the exact tokens '[unplate.template(' in
-  # order to work, we can't write '[unplate_module.template(', so
-  # we need to make the following assignment
-  # TODO: this is gonna act funny if the payload contains a triple-quote
-  unplate = unplate_module
-  # add three underscores after 'template' to reduce change of namespace
-  # conflict with the payload code
-  code = f"""
-[unplate.begin(template___)] @ '''
-{ item['payload'] }
-''' [unplate.end]
+  # Only pass the context fields that the template refers to.
+  # This avoids copying the context, and lets a TrackedContext
+  # record what was read.
+  env = {name: ctx[name] for name in code_names(compiled) if name in ctx}
+  exec(compiled, env)
+
+  item['payload'] = env['template___']
+  return item
+
+def images(*, widths=default_image_widths, sizes=None):
+  """
+  Give the <img>s of an HTML payload resized variants in modern formats,
+  chosen between by the browser; see py/images.py. `sizes` is the HTML
+  sizes attribute, by default the image's own width or the viewport's.
   """
 
-  ctx = {**ctx}
-  exec(unplate_module.compile_anon(code, options=unplate_options), ctx)
+  @composable
+  def builder(item, ctx):
+    item['payload'] = responsive_images(item['payload'], Path(item['target']), widths=widths, sizes=sizes)
+    return item
 
-  item['payload'] = ctx['template___']
-  return item
+  return builder.named('images')
 
 def latex(rel_loc, *, tex_args="", bib_args=""):
   """ Compile a .tex file at the given location, either absolute or relative to the item """
@@ -89,53 +249,122 @@ def latex(rel_loc, *, tex_args="", bib_args=""):
   @composable
   def builder(item, ctx):
     abs_loc = (item['location'].parent / rel_loc).resolve()
-    abs_dir = abs_loc.parent
-    tex_name = rel_loc.stem  # name of the file without .tex
-
-    # pdflatex command modified from https://tex.stackexchange.com/a/459470
-    do_pdflatex = lambda: shell_exec(f"cd \"{abs_dir}\" && ! : | pdflatex {tex_args} -halt-on-error {abs_loc} | grep '^!.*' -A200 --color=always")
-    do_bibtex = lambda: shell_exec(f"cd \"{abs_dir}\" && bibtex -terse {bib_args} {tex_name} | grep '.' --color=always")
+    compile_latex(abs_loc, tex_args=tex_args, bib_args=bib_args)
+    return item
 
-    do_pdflatex()
-    do_bibtex()
-    for _ in range(3):  # Do compilation a bunch of times for e.g. table-of-contents to work
-      do_pdflatex()
+  return builder.named('latex')
 
-  return builder
 
+templates_f = build_source / 'templates.py'
+templates_cache_dir = cache_dir / 'templates'
+loaded_templates = {'key': None, 'module': None}
+loaded_templates_lock = threading.Lock()
 
-# TODO: code smell
-import sys
-sys.path.append('src/')
-import templates
+def load_templates(source=None):
+  """
+  Return src/templates.py as a module, (re)loading it if its source
+  differs from that of the module last loaded, e.g. after an edit while
+  serving. templates.py is compiled by unplate; the compiled code is
+  cached on disk by source hash, so it is only compiled once per edit.
+  """
+  if source is None:
+    with open(templates_f, 'r') as f:
+      source = f.read()
+  _, salt = unplate_settings()
+  key = hashlib.sha256((salt + '\0' + source).encode()).hexdigest()
+
+  with loaded_templates_lock:
+    if loaded_templates['key'] == key:
+      return loaded_templates['module']
+
+    cache_f = templates_cache_dir / f'{key}.marshal'
+    try:
+      with open(cache_f, 'rb') as f:
+        compiled = marshal.load(f)
+    except (FileNotFoundError, EOFError, ValueError, TypeError):
+      import unplate
+      compiled = compile(unplate.compile_code(source, unplate.options.defaults, file_loc=str(templates_f)), str(templates_f), 'exec')
+      templates_cache_dir.mkdir(parents=True, exist_ok=True)
+      tmp_f = cache_f.with_suffix(f'.{threading.get_ident()}.tmp')
+      with open(tmp_f, 'wb') as f:
+        marshal.dump(compiled, f)
+      tmp_f.replace(cache_f)
+
+    module = types.ModuleType('templates')
+    module.__file__ = str(templates_f)
+    exec(compiled, module.__dict__)
+    loaded_templates.update(key=key, module=module)
+    return module
 
 def template(template_name, *args, **kwargs):
-  template = templates.templates[template_name]
 
   @composable
   def builder(item, ctx):
+    # Looked up when run rather than when the chain is made, since
+    # chains are cached (see compile_build) but templates may be reloaded
+    template = (loaded_templates['module'] or load_templates()).templates[template_name]
     result = template(item=item, *args, **kwargs)
+    # The payload without the page around it, for the search index
+    item.setdefault('content', item['payload'])
     item['payload'] = result
     return item
-  return builder
+  return builder.named(f"template({template_name!r})")
+
+@functools.lru_cache(maxsize=None)
+def compile_build(source):
+  """
+  Evaluate an item's build expression to its build chain.
+  Chains are cached by their source, so each distinct chain is only put together once.
+  """
+  return eval(source)
 
 def build_payload(item, build_ctx):
   """
   Build the underling payload of the item
   according to the given metadata.
   Output the built file to the appropriate location.
+  Return the built item, and the names of the context fields that the build read.
   """
 
-  build_f = eval(item['build'])
+  build_f = compile_build(item['build'])
   clone = {**item}
-  built = build_f(clone, ctx=build_ctx)
-
-def item_was_modified(item, *, since):
-  """ Was the item modified since last build? """
-  return any(was_modified(path, since=since) for path in item['files'])
+  ctx = TrackedContext(build_ctx)
+  with profile.profiling_item(str(item['location'].relative_to(build_target))):
+    built = build_f(clone, ctx=ctx)
+  return built, ctx.reads
 
-def build_payloads(items, *, last_build_time):
-  """ Build the payloads of all items """
+def item_digest(item, *, templates_source):
+  """
+  Digest of everything that goes into building an item: its own file,
+  its 'files', its build expression, the templates it may use, and how
+  pages are optimized (see py/assets.py)
+  """
+  return hash_paths(
+    [item['location'], *item['files']],
+    extra=[item['build'], templates_source, assets.optimization_key()],
+  )
+
+def touches(item, changed):
+  """ Are any of the item's files among, or directories containing, the changed paths? """
+  paths = [item['location'], *item['files']]
+  return any(
+    path == changed_path or path in changed_path.parents
+    for changed_path in changed
+    for path in paths
+  )
+
+def build_payloads(items, *, cache, jobs=1, changed=None, search=None):
+  """
+  Build the payloads of all items.
+  An item is skipped if neither its inputs (see item_digest) nor the
+  parts of the build context that it read last time have changed.
+  If given, `changed` is the set of all paths changed since the last build;
+  items not touching any of them are then not re-hashed.
+  With jobs > 1, independent items are built concurrently; each item's
+  log output is held back until it finishes so that logs stay readable.
+  If given, built items are added to the SearchIndex `search`, and
+  indexed items missing from it are built even if otherwise fresh.
+  """
 
   indexed = [item for item in items if item['indexed']]
   index_tree = calc_item_tree(indexed)
@@ -143,18 +372,101 @@ def build_payloads(items, *, last_build_time):
     'items': indexed,
     'top_level_items': index_tree[0]['items'],
     'item_tree': index_tree[0]['children'],
-    'tags': set(flatten([item['tags'] for item in indexed])),
+    # Sorted so that pages listing tags come out the same on every build
+    'tags': sorted(set(flatten([item['tags'] for item in indexed]))),
   }
+  build_ctx['tag_hrefs'] = {tag: tag_href(tag) for tag in build_ctx['tags']}
+  fingerprints = ContextFingerprints(build_ctx)
+
+  def is_fresh(item, loc, digest):
+    entry = cache.get(str(loc))
+    return (
+      (search is None or not item['indexed'] or search.has(loc))
+      and isinstance(entry, dict)
+      and entry['inputs'] == digest
+      and all(fingerprints[key] == fp for key, fp in entry['context'].items())
+    )
+
+  with open(templates_f, 'r') as f:
+    templates_source = f.read()
+
+  # Every item depends on the templates
+  if changed is not None and build_target / 'templates.py' in changed:
+    changed = None
+
+  # and on how pages are optimized, such as the URLs of fingerprinted assets
+  optimization = assets.optimization_key()
+  if changed is not None and cache.get('_optimization') != optimization:
+    changed = None
 
   with log_section("Building payloads"):
+    # Digests are all taken before building anything, since
+    # building an item may write into another item's files
+    to_build = []
     for item in items:
       loc = item['location'].relative_to(build_target)
+      entry = cache.get(str(loc))
+      if changed is not None and isinstance(entry, dict) and not touches(item, changed):
+        digest = entry['inputs']
+      else:
+        digest = item_digest(item, templates_source=templates_source)
 
-      if not item_was_modified(item, since=last_build_time):
-        log(f"- skipping '{loc}' because it has not been modified since the last build")
+      if is_fresh(item, loc, digest):
+        log(f"- skipping '{loc}' because it has not changed since the last build")
+        count('items_skipped')
       else:
-        with log_section(f"@ building '{loc}'"):
-          build_payload(item, build_ctx)
+        to_build.append(item)
 
-    log(f"{len(indexed)} payloads built")
+    # Make sure that items are built with the current templates
+    if to_build:
+      load_templates(templates_source)
 
+    def build_and_record(item):
+      built, reads = build_payload(item, build_ctx)
+      loc = item['location'].relative_to(build_target)
+      if search is not None and item['indexed'] and isinstance(built, dict):
+        search.update(loc, built)
+      # The digest is taken again since items often write
+      # their output among their own files
+      cache.record(str(loc), {
+        'inputs': item_digest(item, templates_source=templates_source),
+        'context': {key: fingerprints[key] for key in sorted(reads)},
+      })
+      count('items_built')
+
+    if jobs <= 1:
+      for item in to_build:
+        loc = item['location'].relative_to(build_target)
+        try:
+          with log_section(f"@ building '{loc}'"):
+            build_and_record(item)
+        except Exception as e:
+          error(f"{type(e).__name__}: {e}", item=str(loc))
+          raise
+
+    else:
+      def build_buffered(item):
+        loc = item['location'].relative_to(build_target)
+        with buffered():
+          try:
+            with log_section(f"@ building '{loc}'"):
+              build_and_record(item)
+          except Exception as e:
+            log(traceback.format_exc())
+            error(f"{type(e).__name__}: {e}", item=str(loc))
+            return loc
+        return None
+
+      # Each item is built in a copy of this context, so that it's logged nested under this section
+      with ThreadPoolExecutor(max_workers=jobs) as pool:
+        failed = [loc for loc in pool.map(in_context(build_buffered), to_build) if loc is not None]
+
+      if failed:
+        raise BuildError(
+          f"{len(failed)} item(s) failed to build: "
+          + ', '.join(f"'{loc}'" for loc in failed)
+        )
+
+    # Only once everything is built, since items not yet rebuilt still have digests with the old key
+    cache.record('_optimization', optimization)
+    log(f"{len(indexed)} payloads built")
@@ -0,0 +1,33 @@
+import json
+import threading
+
+class BuildCache:
+  """
+  Persistent record of the inputs that each part of the site
+  was last successfully built from.
+  Entries map a key (e.g. an item location) to a digest of its inputs,
+  or to any other JSON-able record of them; a part needs rebuilding iff
+  its current inputs differ from the recorded ones.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.lock = threading.Lock()
+    try:
+      with open(path, 'r') as f:
+        self.entries = json.load(f)
+    except (FileNotFoundError, ValueError):
+      self.entries = {}
+
+  def get(self, key):
+    with self.lock:
+      return self.entries.get(key)
+
+  def record(self, key, digest):
+    with self.lock:
+      self.entries[key] = digest
+
+  def save(self):
+    with self.lock:
+      with open(self.path, 'w') as f:
+        json.dump(self.entries, f, indent=1, sort_keys=True)
@@ -1,3 +1,4 @@
+import functools
 
 def calc_item_tree(items):
   """
@@ -40,55 +41,109 @@ def calc_item_tree(items):
   a strict subset of school, but they are both subsets of each other,
   both appear at the top-level of the tree.
   Also note that math.txt appears in two places in the tree.
+
+  Internally, sets of items and sets of tags are represented as bitsets
+  (Python ints), with bit i standing for items[i] or tags[i].
+
+  The shape of the tree only depends on the titles and tags of the items,
+  so it is memoized on those; rebuilds which don't touch them reuse it.
   """
 
-  tags = sorted(set(tag for item in items for tag in item['tags']))
-  return [calc_item_tree_aux(items, None, [], tags)]
+  key = tuple((item['title'], tuple(item['tags'])) for item in items)
+  return [materialize(calc_tree_shape(key), items)]
 
-def strict_superset(li0, li1):
-  return len(li0) > len(li1) and all(x in li0 for x in li1)
+@functools.lru_cache(maxsize=4)
+def calc_tree_shape(key):
+  # Calculate the item tree, with items given by their index
+  items = [{'title': title, 'tags': tags} for title, tags in key]
+  tags = sorted(set(tag for item in items for tag in item['tags']))
+  index = TagIndex(items, tags)
+  all_items = (1 << len(items)) - 1
+  universe = (1 << len(tags)) - 1
+  return calc_item_tree_aux(index, None, 0, all_items, universe, universe)
 
-def without(li, x):
-  li_ = li[:]
-  li_.remove(x)
-  return li_
+def materialize(shape, items):
+  # Replace item indexes in a tree shape with the items themselves
+  return {
+    "tag": shape["tag"],
+    "items": [items[i] for i in shape["items"]],
+    "children": [materialize(child, items) for child in shape["children"]],
+  }
 
-def calc_item_tree_aux(items, tag, tags, universe):
+def bits(mask):
+  """ Yield the indexes of the set bits of a bitset, lowest first """
+  while mask:
+    low = mask & -mask
+    yield low.bit_length() - 1
+    mask ^= low
+
+class TagIndex:
+  """ Precomputed tag/item relations for calc_item_tree """
+
+  def __init__(self, items, tags):
+    self.items = items
+    self.tags = tags
+    tag_pos = {tag: t for t, tag in enumerate(tags)}
+
+    # with_tag[t]: the items with tags[t]
+    self.with_tag = [0] * len(tags)
+    # with_tag_count[n]: the items with exactly n distinct tags
+    self.with_tag_count = {}
+    # cooccurring[t]: the tags which appear on some item together with tags[t]
+    self.cooccurring = [0] * len(tags)
+    for i, item in enumerate(items):
+      item_tags = set(item['tags'])
+      item_tag_mask = 0
+      for tag in item_tags:
+        self.with_tag[tag_pos[tag]] |= 1 << i
+        item_tag_mask |= 1 << tag_pos[tag]
+      for tag in item_tags:
+        self.cooccurring[tag_pos[tag]] |= item_tag_mask
+      n = len(item_tags)
+      self.with_tag_count[n] = self.with_tag_count.get(n, 0) | 1 << i
+
+    # supersets[t]: the tags whose items are a strict superset of those of tags[t]
+    self.supersets = [0] * len(tags)
+    for t, mask in enumerate(self.with_tag):
+      for u, other in enumerate(self.with_tag):
+        if other != mask and other & mask == mask:
+          self.supersets[t] |= 1 << u
+
+def calc_item_tree_aux(index, tag, depth, path_items, universe, candidates):
   # Auxiliary item tree calculation function
-  # Takes `items`, the list of all items,
+  # Takes `index`, the TagIndex of all items
   #       `tag`, the tag of the current branch
-  #       `tags`, the ancestor tags (i.e. the path on the tree so far)
-  #       `universe`, all tags in the tree
-
-  def items_with(tag):
-    return [item for item in items if tag in item['tags']]
+  #       `depth`, the number of ancestor tags (i.e. the length of the path on the tree so far)
+  #       `path_items`, the items having all the ancestor tags
+  #       `universe`, all tags in the tree, as a bitset
+  #       `candidates`, the tags which co-occur with every ancestor tag, as a bitset;
+  #                     only these can lead to a nonempty branch
 
+  # Items with all the ancestor tags and no more have exactly `depth` tags
   rose = sorted(
-    [item for item in items if set(item['tags']) == set(tags)],
-    key=lambda item: item['title']
+    bits(path_items & index.with_tag_count.get(depth, 0)),
+    key=lambda i: index.items[i]['title']
   )
 
   children = []
-  for child_tag in universe:
+  for child in bits(universe & candidates):
+    child_items = path_items & index.with_tag[child]
+
     # If going down this path contains at least one item
-    nonempty = any(
-      set(item['tags']) >= {*tags, child_tag}
-      for item in items
-    )
+    nonempty = child_items != 0
 
-    # If this  tag is a strict subset of another tag
-    subset = any(
-      strict_superset(items_with(tag), items_with(child_tag))
-      for tag in universe
-    )
+    # If this tag is a strict subset of another tag
+    subset = index.supersets[child] & universe != 0
 
     if nonempty and not subset:
       children.append(
         calc_item_tree_aux(
-          items,
-          child_tag,
-          tags + [child_tag],
-          without(universe, child_tag)
+          index,
+          index.tags[child],
+          depth + 1,
+          child_items,
+          universe & ~(1 << child),
+          candidates & index.cooccurring[child],
         )
       )
 
@@ -97,4 +152,3 @@ def calc_item_tree_aux(items, tag, tags, universe):
     "items": rose,
     "children": children,
   }
-  
@@ -0,0 +1,74 @@
+import os
+import json
+import types
+import hashlib
+import threading
+from pathlib import Path
+
+from .globals import build_target
+
+class TrackedContext(dict):
+  """
+  A build context which records which of its fields are read.
+  Every item gets its own, so that after building an item we know
+  which parts of the context its build chain depended on.
+  """
+
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.reads = set()
+
+  def __getitem__(self, key):
+    self.reads.add(key)
+    return super().__getitem__(key)
+
+  def get(self, key, default=None):
+    self.reads.add(key)
+    return super().get(key, default)
+
+def code_names(code):
+  """ All names referenced by a code object, including by nested code """
+  names = set(code.co_names)
+  for const in code.co_consts:
+    if isinstance(const, types.CodeType):
+      names |= code_names(const)
+  return names
+
+def _metadata(value):
+  # Project a context value onto a JSON-able value, leaving
+  # out item payloads. This way, other items' bodies are not
+  # considered part of the context; an item that depends on them
+  # should list them in its 'files'.
+  if isinstance(value, dict):
+    return {
+      str(key): _metadata(val)
+      for key, val in value.items()
+      if key != 'payload'
+    }
+  if isinstance(value, (set, frozenset)):
+    return sorted(_metadata(val) for val in value)
+  if isinstance(value, (list, tuple)):
+    return [_metadata(val) for val in value]
+  if isinstance(value, Path):
+    # Relative, so that fingerprints are the same in any checkout
+    return os.path.relpath(value, build_target)
+  return value
+
+def fingerprint(value):
+  """ Digest of the metadata in a context value """
+  serialized = json.dumps(_metadata(value), sort_keys=True, default=str)
+  return hashlib.sha256(serialized.encode()).hexdigest()
+
+class ContextFingerprints:
+  """ Lazily computed and memoized fingerprints of each field of a context """
+
+  def __init__(self, ctx):
+    self.ctx = ctx
+    self.fingerprints = {}
+    self.lock = threading.Lock()
+
+  def __getitem__(self, key):
+    with self.lock:
+      if key not in self.fingerprints:
+        self.fingerprints[key] = fingerprint(self.ctx.get(key))
+      return self.fingerprints[key]
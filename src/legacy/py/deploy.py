@@ -0,0 +1,144 @@
+import os
+import json
+import shlex
+import hashlib
+import tempfile
+from pathlib import Path
+
+from .globals import build_target, build_cache_f, cache_dir, internal_files, deploy_state_dir
+from .log import log_section, log
+from .scan import default_ignore, scan_files
+from .util import shell_exec, hash_file
+
+# File in cache_dir remembering the hashes of built files by size and mtime
+stat_cache_name = 'deploy_stat_cache.json'
+
+# Deploys which would delete more than this fraction of the deployed files
+# are refused without force=True, as they're more likely a broken build
+max_removed_fraction = 0.5
+
+
+class DeployError(Exception):
+  pass
+
+
+def load_json(path, default):
+  try:
+    with open(path, 'r') as f:
+      return json.load(f)
+  except (FileNotFoundError, ValueError):
+    return default
+
+
+def save_json(path, value):
+  path.parent.mkdir(parents=True, exist_ok=True)
+  tmp_path = path.with_name(path.name + '.tmp')
+  with open(tmp_path, 'w') as f:
+    json.dump(value, f, indent=1, sort_keys=True)
+  os.replace(tmp_path, path)
+
+
+def content_manifest(directory: Path):
+  """
+  Map the path of each deployable file in `directory`, relative to it,
+  to the hash of its contents.
+  A file whose size and mtime are unchanged since the last call is not
+  re-read; its hash is taken from a stat cache kept in cache_dir.
+  """
+  stat_cache_f = directory / cache_dir.name / stat_cache_name
+  stat_cache = load_json(stat_cache_f, {})
+  new_stat_cache = {}
+  manifest = {}
+
+  for path in scan_files(directory, suffix='', ignore=default_ignore + internal_files):
+    rel = str(path.relative_to(directory))
+    stat = path.stat()
+    key = [stat.st_size, stat.st_mtime_ns]
+    prev = stat_cache.get(rel)
+    digest = prev[2] if prev is not None and prev[:2] == key else hash_file(path)
+    new_stat_cache[rel] = key + [digest]
+    manifest[rel] = digest
+
+  save_json(stat_cache_f, new_stat_cache)
+  return manifest
+
+
+def deployed_manifest_f(destination):
+  """
+  Where the manifest of what was last deployed to a destination is kept.
+  This lives outside of build/ so that it survives --from-scratch builds.
+  """
+  name = hashlib.sha256(destination.encode()).hexdigest()[:16]
+  return deploy_state_dir / f'{name}.json'
+
+
+def batches(paths, size):
+  for i in range(0, len(paths), size):
+    yield paths[i:i + size]
+
+
+def deploy(destination, *, batch_size=1000, dry_run=False, force=False):
+  """
+  Bring `destination`, an rsync destination such as 'user@host:/var/www/'
+  or a local directory, up to date with the build directory.
+
+  Only files whose content changed since the last deploy to the same
+  destination, according to the manifest saved then, are sent; files
+  which have since disappeared from the build are deleted. Files are
+  handed to rsync in batches via --files-from, and the saved manifest is
+  updated after each batch, so an interrupted deploy picks up where it
+  left off.
+
+  Since a missing or incomplete build would delete the site, deploying
+  is refused if there is no finished build, or unless `force` is given,
+  if it would delete much of what was deployed.
+  """
+  # The build cache is only written once a build has got going
+  if not build_cache_f.is_file():
+    raise DeployError(f"There is no build in {build_target} to deploy; run 'site.py build' first")
+
+  manifest_f = deployed_manifest_f(destination)
+  deployed = load_json(manifest_f, {}).get('files', {})
+
+  with log_section("Hashing build", multiline=False):
+    current = content_manifest(build_target)
+
+  changed = sorted(rel for rel, digest in current.items() if deployed.get(rel) != digest)
+  removed = sorted(set(deployed) - set(current))
+  log(f"{len(changed)} file(s) to send, {len(removed)} to delete, {len(current) - len(changed)} unchanged")
+
+  if not current:
+    raise DeployError(f"The build in {build_target} is empty; refusing to deploy it")
+  if deployed and len(removed) > max_removed_fraction * len(deployed) and not force:
+    raise DeployError(
+      f"This would delete {len(removed)} of the {len(deployed)} file(s) deployed to {destination};"
+      " check the build, and use --force if this is intended"
+    )
+
+  if dry_run:
+    for rel in changed:
+      log(f"send {rel}")
+    for rel in removed:
+      log(f"delete {rel}")
+    return
+
+  for batch in batches(changed + removed, batch_size):
+    with log_section(f"Sending {len(batch)} file(s) to {destination}", multiline=False):
+      with tempfile.NamedTemporaryFile('w', prefix='deploy-', suffix='.txt') as files_from:
+        files_from.write('\n'.join(batch) + '\n')
+        files_from.flush()
+        # --files-from implies --relative, so parent directories are created as needed.
+        # Removed files are listed too; --delete-missing-args deletes them at the destination.
+        # --ignore-times since we already know that every listed file differs.
+        shell_exec(
+          f"rsync --links --perms --times --compress --ignore-times --delete-missing-args"
+          f" --files-from={shlex.quote(files_from.name)}"
+          f" {shlex.quote(str(build_target) + '/')} {shlex.quote(destination)}"
+        )
+
+    for rel in batch:
+      if rel in current:
+        deployed[rel] = current[rel]
+      else:
+        deployed.pop(rel, None)
+    save_json(manifest_f, {'destination': destination, 'files': deployed})
@@ -1,7 +1,41 @@
+import os
 from pathlib import Path
 
 build_source = Path('src/').resolve()
 build_target = Path('build/').resolve()
 
-# File containing the last build time
-build_time_f = build_target / '_build_time.txt'
+# File containing the build cache; see py/cache.py
+build_cache_f = build_target / '_build_cache.json'
+
+# Manifest of files synced from build_source; see py/sync.py
+sync_manifest_f = build_target / '_sync_manifest.json'
+
+# Cache of parsed items; see py/parse.py
+parse_cache_f = build_target / '_parse_cache.pickle'
+
+# Directory for caches of intermediate build products
+cache_dir = build_target / '_cache'
+
+# The outputs changed by the last build; see py/output.py
+changed_outputs_f = build_target / '_changed_outputs.json'
+
+# Names of the build bookkeeping files in build_target, which are not part of the site
+internal_files = [
+  build_cache_f.name,
+  sync_manifest_f.name,
+  parse_cache_f.name,
+  cache_dir.name,
+  changed_outputs_f.name,
+]
+
+# What was last deployed where; see py/deploy.py.
+# Outside of build_target, so that it survives building from scratch.
+deploy_state_dir = Path('.deploy/').resolve()
+
+# Content-addressed store of expensive build outputs; see py/artifacts.py.
+# Outside of build_target so that it survives building from scratch, and
+# may be pointed somewhere shared between clones with SITE_ARTIFACT_STORE.
+artifact_store_dir = Path(os.environ.get('SITE_ARTIFACT_STORE', '.artifacts/')).resolve()
+
+# Least recently used artifacts are evicted once the store is larger than this
+artifact_store_max_size = os.environ.get('SITE_ARTIFACT_STORE_MAX_SIZE', '1G')
@@ -0,0 +1,255 @@
+"""
+Responsive images: resized variants of raster images in modern formats,
+and the markup to let browsers choose between them.
+
+Pillow is an optional dependency; without it, images are left as they are.
+Conversions are done in a pool of worker processes, and cached in the
+artifact store (see py/artifacts.py) by source hash and parameters, so
+images are only re-encoded when they change.
+"""
+
+import os
+import re
+import html
+import hashlib
+import functools
+import posixpath
+import threading
+import warnings
+from pathlib import Path
+
+from .globals import build_target
+from .artifacts import default_store
+from .sync import copy_file
+from .util import hash_file
+from .log import log, count
+
+# Widths of the variants made of each image, besides its own
+default_widths = [480, 960, 1600]
+
+# Formats to try variants in, besides the image's own; a variant in one
+# of these is only used if it's smaller than the variant in the image's own
+modern_formats = ['avif', 'webp']
+
+raster_formats = {'.png': 'png', '.jpg': 'jpeg', '.jpeg': 'jpeg', '.webp': 'webp'}
+extensions = {'png': '.png', 'jpeg': '.jpg', 'webp': '.webp', 'avif': '.avif'}
+mime_types = {'png': 'image/png', 'jpeg': 'image/jpeg', 'webp': 'image/webp', 'avif': 'image/avif'}
+save_options = {
+  'png': {'optimize': True},
+  'jpeg': {'quality': 85, 'optimize': True, 'progressive': True},
+  'webp': {'quality': 80, 'method': 6},
+  'avif': {'quality': 60},
+}
+
+@functools.lru_cache(maxsize=None)
+def pillow():
+  """ Pillow's version and the formats it can write, or None if it isn't installed """
+  try:
+    import PIL
+    import PIL.features
+  except ImportError:
+    return None
+  with warnings.catch_warnings():
+    # Older versions warn about features they don't know, like avif
+    warnings.simplefilter('ignore')
+    formats = ['png', 'jpeg'] + [fmt for fmt in modern_formats if PIL.features.check(fmt)]
+  return PIL.__version__, formats
+
+def convert(source, target, width, fmt):
+  """
+  Write the image at source to target, resized to the given width and
+  in the given format. Runs in a worker process. Returns the size written.
+  """
+  from PIL import Image
+  with Image.open(source) as image:
+    image.load()
+    if image.width != width:
+      height = max(1, round(image.height * width / image.width))
+      # Image.Resampling is new in Pillow 9.1; before, the filters were on Image
+      image = image.resize((width, height), getattr(Image, 'Resampling', Image).LANCZOS)
+    if fmt == 'jpeg' and image.mode not in ('RGB', 'L'):
+      image = image.convert('RGB')
+    image.save(target, format=fmt.upper(), **save_options[fmt])
+  return os.path.getsize(target)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def pool():
+  """ The process pool for conversions, started when first needed """
+  global _pool
+  with _pool_lock:
+    if _pool is None:
+      # Imported here since they're slow to import, and every command imports this module
+      import multiprocessing
+      from concurrent.futures import ProcessPoolExecutor
+      # Not forked, since the build may be running other threads
+      _pool = ProcessPoolExecutor(mp_context=multiprocessing.get_context('spawn'))
+    return _pool
+
+_conversion_locks = {}
+_conversion_locks_lock = threading.Lock()
+
+def conversion_lock(key):
+  """ The lock held while converting an image with the given key """
+  with _conversion_locks_lock:
+    return _conversion_locks.setdefault(key, threading.Lock())
+
+def image_variants(source: Path, widths=default_widths):
+  """
+  Make the variants of an image, next to it, and return a description of
+  them: {'width', 'height', 'variants': [[format, width, file name], ...]}.
+  The image itself is included as the variant in its own format and width.
+  Returns None if the image can't be converted.
+  """
+  fmt = raster_formats.get(source.suffix.lower())
+  installed = pillow()
+  if fmt is None or installed is None:
+    return None
+  version, formats = installed
+
+  source_hash = hash_file(source)
+  key = hashlib.sha256('\0'.join([
+    'image', source_hash, repr(widths), repr(formats), repr(save_options), version,
+  ]).encode()).hexdigest()
+  # Variants are named after the key, so that they can be cached forever
+  prefix = f'{source.stem}.{key[:10]}'
+
+  # Pages built at the same time may share an image; the first to get
+  # here converts it, and the others then find it in the store
+  with conversion_lock(key):
+    store = default_store()
+    found = store.get(key)
+    if found is None:
+      from PIL import Image
+      try:
+        with Image.open(source) as image:
+          size = image.size
+      except OSError:
+        return None
+
+      full_width = size[0]
+      all_widths = sorted({*(width for width in widths if width < full_width), full_width})
+      targets = [(fmt, width) for width in all_widths if width != full_width]
+      targets += [(other, width) for other in formats if other in modern_formats and other != fmt for width in all_widths]
+      paths = {(other, width): source.with_name(f'{prefix}.{width}w{extensions[other]}') for other, width in targets}
+      futures = {
+        target: pool().submit(convert, str(source), str(paths[target]), target[1], target[0])
+        for target in targets
+      }
+      # Wait for all of them even if one fails, so as not to leave any behind
+      sizes = {}
+      error = None
+      for target, future in futures.items():
+        try:
+          sizes[target] = future.result()
+        except Exception as e:
+          error = e
+      if error is not None:
+        log(f"- couldn't convert '{source.name}', so leaving it as it is: {type(error).__name__}: {error}")
+        for path in paths.values():
+          path.unlink(missing_ok=True)
+        return None
+
+      # Only keep variants which are an improvement: resized ones which are
+      # smaller than the image itself, and modern ones which are smaller than
+      # what the image's own format has at that width
+      original = source.stat().st_size
+      best = {}
+      variants = []
+      for width in all_widths:
+        if width == full_width:
+          variants.append([fmt, width, source.name])
+        elif sizes[fmt, width] < original:
+          variants.append([fmt, width, paths[fmt, width].name])
+          best[width] = sizes[fmt, width]
+        else:
+          paths.pop((fmt, width)).unlink()
+      for (other, width), size_written in sorted(sizes.items()):
+        if other == fmt:
+          continue
+        if size_written < best.get(width, original):
+          variants.append([other, width, paths[other, width].name])
+        else:
+          paths.pop((other, width)).unlink()
+
+      info = {'width': size[0], 'height': size[1], 'variants': variants}
+      store.put(key, {path.name: path for path in paths.values()}, {'source': source.name, 'image': info})
+      log(f"- made {len(variants) - 1} variant(s) of '{source.name}'")
+      count('images_converted')
+      return info
+
+    meta, files = found
+    for name in meta['files']:
+      target = source.with_name(name)
+      if not target.exists():
+        copy_file(files / name, target)
+    # The entry may have been made from an identical image under another name
+    info = meta['image']
+    variants = [
+      [fmt, width, source.name if name == meta['source'] else name]
+      for fmt, width, name in info['variants']
+    ]
+    return {**info, 'variants': variants}
+
+
+_attribute = re.compile(r'''([^\s=/>]+)(?:\s*=\s*("[^"]*"|'[^']*'|[^\s>]+))?''')
+
+def picture_html(src, info, attributes, sizes=None):
+  """ Markup for an image with the given variants, as <picture>, keeping the other attributes of its <img> """
+  directory = posixpath.dirname(src)
+  url = lambda name: posixpath.join(directory, name) if directory else name
+  if sizes is None:
+    # Shown no wider than the image itself
+    sizes = f"(max-width: {info['width']}px) 100vw, {info['width']}px"
+
+  by_format = {}
+  for fmt, width, name in info['variants']:
+    by_format.setdefault(fmt, []).append(f'{url(name)} {width}w')
+  own_format = info['variants'][0][0]
+
+  lines = ['<picture>']
+  for fmt in modern_formats:
+    if fmt in by_format and fmt != own_format:
+      lines.append(f'<source type="{mime_types[fmt]}" srcset="{", ".join(by_format[fmt])}" sizes="{sizes}">')
+  img_attributes = ''.join(
+    f' {name}' if value is None else f' {name}={value}'
+    for name, value in attributes
+  )
+  lines.append(f'<img{img_attributes} srcset="{", ".join(by_format[own_format])}" sizes="{sizes}">')
+  lines.append('</picture>')
+  return '\n'.join(lines)
+
+_img = re.compile(r'<img\b[^>]*>', re.I)
+
+def responsive_images(markup, page: Path, *, widths=default_widths, sizes=None):
+  """
+  Rewrite the <img>s in a page which refer to local raster images into
+  <picture>s with resized and converted variants.
+  `page` is where the page will be written, for resolving relative URLs.
+  Images which already have a srcset are left alone.
+  """
+  if pillow() is None:
+    return markup
+
+  def replace(match):
+    attributes = _attribute.findall(match.group(0)[len('<img'):].rstrip('/>'))
+    attributes = [(name, value or None) for name, value in attributes]
+    names = {name.lower() for name, _ in attributes}
+    src = next((value for name, value in attributes if name.lower() == 'src'), None)
+    if src is None or 'srcset' in names:
+      return match.group(0)
+
+    url = html.unescape(src.strip('"\''))
+    if re.match(r'^([a-z][a-z0-9+.-]*:|//)', url, re.I) or '?' in url or '#' in url:
+      return match.group(0)
+    path = build_target / url.lstrip('/') if url.startswith('/') else page.parent / url
+    if not path.is_file():
+      return match.group(0)
+
+    info = image_variants(path.resolve(), widths)
+    if info is None:
+      return match.group(0)
+    return picture_html(url, info, attributes, sizes)
+
+  return _img.sub(replace, markup)
@@ -0,0 +1,231 @@
+import os
+import json
+import hashlib
+import functools
+import subprocess
+from pathlib import Path
+
+from .globals import build_target
+from .log import log
+from . import profile
+from .artifacts import default_store
+from .scan import default_ignore, scan_files
+from .sync import copy_file
+from .util import shell_exec, hash_paths, hash_file
+
+# pdflatex is run at most this many times per compilation
+max_passes = 5
+
+# Files written by pdflatex and bibtex whose contents feed back
+# into the next pass; once they stop changing, the document is done
+feedback_suffixes = ['.aux', '.toc', '.lof', '.lot', '.out', '.bbl', '.nav', '.snm']
+
+# Files that compilation writes next to the .tex, besides the feedback files
+output_suffixes = ['.pdf', '.log', '.fls', '.blg', '.synctex.gz', '.latex-state.json']
+
+def digest_files(paths):
+  digest = hashlib.sha256()
+  for path in paths:
+    digest.update(str(path).encode() + b'\0')
+    if path.is_file():
+      digest.update(b'\1' + path.read_bytes())
+  return digest.hexdigest()
+
+def citation_lines(aux_f):
+  """ The lines of an .aux file which bibtex cares about """
+  if not aux_f.is_file():
+    return []
+  with open(aux_f, 'r', errors='replace') as f:
+    return [
+      line for line in f
+      if line.startswith(('\\citation', '\\bibdata', '\\bibstyle'))
+    ]
+
+def recorded_inputs(tex_f, fls_f, aux_f):
+  """
+  The source files that the last pdflatex run read, according to its
+  -recorder output, plus the .tex itself and any bibliography databases named in the .aux.
+  Only files within the build directory are included; TeX's own files are not.
+  """
+  tex_dir = tex_f.parent
+  inputs = {tex_f.resolve()}
+
+  if fls_f.is_file():
+    with open(fls_f, 'r', errors='replace') as f:
+      for line in f:
+        if line.startswith('INPUT '):
+          path = (tex_dir / line[len('INPUT '):].strip()).resolve()
+          if build_target in path.parents and path.suffix not in feedback_suffixes:
+            inputs.add(path)
+
+  for line in citation_lines(aux_f):
+    if line.startswith('\\bibdata'):
+      names = line.strip()[len('\\bibdata{'):-len('}')]
+      for name in names.split(','):
+        inputs.add((tex_dir / f'{name}.bib').resolve())
+
+  return sorted(inputs)
+
+@functools.lru_cache(maxsize=None)
+def tool_version(command):
+  """ The first line of a tool's --version output """
+  try:
+    result = subprocess.run([command, '--version'], capture_output=True, text=True, timeout=60)
+  except (OSError, subprocess.SubprocessError):
+    return ''
+  lines = result.stdout.splitlines()
+  return lines[0] if lines else ''
+
+def artifact_key(tex_f, args):
+  """
+  Key in the artifact store for compiling a .tex file: a digest of its
+  location in the build directory, the files in its directory (other than
+  the outputs of compiling any document there, which come and go as they're
+  compiled), the arguments, and the versions of pdflatex and bibtex.
+  Inputs from outside of the directory are accounted for by inputs_key.
+  """
+  tex_dir = tex_f.parent
+  outputs = {
+    path.stem + suffix
+    for path in tex_dir.glob('*.tex')
+    for suffix in feedback_suffixes + output_suffixes
+  }
+  sources = [
+    path for path in scan_files(tex_dir, suffix='', ignore=default_ignore)
+    if not (path.parent == tex_dir and path.name in outputs)
+  ]
+  digest = hashlib.sha256()
+  # Paths are relative to the build, so that the key is the same in any clone
+  for string in [os.path.relpath(tex_f, build_target), *args, tool_version('pdflatex'), tool_version('bibtex')]:
+    digest.update(string.encode() + b'\0')
+  for path in sources:
+    digest.update(str(path.relative_to(tex_dir)).encode() + b'\0' + hash_file(path).encode() + b'\0')
+  return digest.hexdigest()
+
+def outside_inputs(tex_dir, inputs):
+  """ The inputs from outside of a directory, relative to it """
+  return sorted(
+    rel for rel in (os.path.relpath(path, tex_dir) for path in inputs)
+    if rel.split(os.sep, 1)[0] == os.pardir
+  )
+
+def inputs_key(key, tex_dir, outside):
+  """ Key in the artifact store for the compiled files, given artifact_key and the current contents of the outside inputs """
+  digest = hashlib.sha256(key.encode() + b'\0')
+  for rel in outside:
+    path = tex_dir / rel
+    digest.update(rel.encode() + b'\0' + (hash_file(path).encode() if path.is_file() else b'<missing>') + b'\0')
+  return digest.hexdigest()
+
+def write_state(state_f, tex_dir, inputs, args):
+  """ Record what a compilation read, relative to the directory so that the record holds in any checkout """
+  with open(state_f, 'w') as f:
+    json.dump({
+      'inputs': [os.path.relpath(path, tex_dir) for path in inputs],
+      'digest': hash_paths(inputs, extra=args),
+    }, f)
+
+def restore_artifact(tex_f, key, args, state_f):
+  """
+  Put a compiled PDF from the artifact store in place, if there is one. Return whether there was.
+  Which inputs from outside of its directory the document reads is only known once it's compiled,
+  so the entry under `key` just lists them, and the files are stored under inputs_key.
+  """
+  tex_dir = tex_f.parent
+  store = default_store()
+  listing = store.get(key)
+  if listing is None:
+    return False
+  found = store.get(inputs_key(key, tex_dir, listing[0]['outside']))
+  if found is None:
+    return False
+  meta, files = found
+  for rel in meta['files']:
+    copy_file(files / rel, tex_dir / rel)
+  write_state(state_f, tex_dir, [tex_dir / rel for rel in meta['inputs']], args)
+  return True
+
+def store_artifact(tex_f, key, inputs, files):
+  """ Put a compiled PDF and the files needed to recompile it quickly in the artifact store """
+  tex_dir = tex_f.parent
+  outside = outside_inputs(tex_dir, inputs)
+  store = default_store()
+  store.put(key, {}, {'source': tex_f.name, 'outside': outside})
+  store.put(
+    inputs_key(key, tex_dir, outside),
+    {path.name: path for path in files if path.is_file()},
+    {'source': tex_f.name, 'inputs': [os.path.relpath(path, tex_dir) for path in inputs]},
+  )
+
+def compile_latex(tex_f: Path, *, tex_args="", bib_args=""):
+  """
+  Compile a .tex file to a PDF.
+
+  Compilation is skipped entirely if the PDF exists and none of the files
+  that went into it (the .tex, anything it included, and .bib files)
+  changed since it was made. Otherwise pdflatex is re-run only until
+  its auxiliary outputs stop changing, and bibtex is only run if the
+  document cites anything and its citations changed.
+
+  Compiled PDFs are also kept in the artifact store (see py/artifacts.py),
+  so that a fresh build directory or another clone can reuse them.
+  """
+  tex_dir = tex_f.parent
+  tex_name = tex_f.stem  # name of the file without .tex
+
+  output = lambda suffix: tex_dir / (tex_name + suffix)
+  pdf_f = output('.pdf')
+  aux_f = output('.aux')
+  state_f = output('.latex-state.json')
+  feedback_files = [output(suffix) for suffix in feedback_suffixes]
+  args = [tex_args, bib_args]
+
+  try:
+    with open(state_f, 'r') as f:
+      state = json.load(f)
+  except (FileNotFoundError, ValueError):
+    state = None
+
+  if (
+    state is not None
+    and pdf_f.is_file()
+    and hash_paths([tex_dir / rel for rel in state['inputs']], extra=args) == state['digest']
+  ):
+    log(f"- skipping '{tex_f.name}' because it has not changed since the last successful build")
+    profile.cache_hit()
+    return
+
+  key = artifact_key(tex_f, args)
+  if restore_artifact(tex_f, key, args, state_f):
+    log(f"- restored '{pdf_f.name}' from the artifact store")
+    profile.cache_hit()
+    return
+
+  # pdflatex command modified from https://tex.stackexchange.com/a/459470
+  do_pdflatex = lambda: shell_exec(f"cd \"{tex_dir}\" && ! : | pdflatex -recorder {tex_args} -halt-on-error {tex_f} | grep '^!.*' -A200 --color=always")
+  do_bibtex = lambda: shell_exec(f"cd \"{tex_dir}\" && bibtex -terse {bib_args} {tex_name} | grep '.' --color=always")
+
+  # Compare against the previous build's outputs, if any; if the first
+  # pass reproduces them exactly, there's no need for a second
+  previous = digest_files(feedback_files)
+  bibtex_for = None
+
+  for passes in range(1, max_passes + 1):
+    log(f"pdflatex pass {passes}")
+    do_pdflatex()
+
+    citations = citation_lines(aux_f)
+    if citations and citations != bibtex_for:
+      log("bibtex")
+      do_bibtex()
+      bibtex_for = citations
+
+    current = digest_files(feedback_files)
+    if current == previous:
+      break
+    previous = current
+
+  inputs = [str(path) for path in recorded_inputs(tex_f, output('.fls'), aux_f)]
+  write_state(state_f, tex_dir, inputs, args)
+
+  store_artifact(tex_f, key, inputs, [pdf_f, *feedback_files])
@@ -1,15 +1,65 @@
-import time
 import sys
+import json
+import time
+import threading
+import contextvars
+from collections import Counter
 from contextlib import contextmanager
 
-depth = 0
+# Logging state is kept in context variables, so that each thread, and
+# each item built concurrently, has its own nesting and doesn't mangle
+# the others' indentation
+_depth = contextvars.ContextVar('log_depth', default=0)
+_sections = contextvars.ContextVar('log_sections', default=())
+_buffer = contextvars.ContextVar('log_buffer', default=None)
+
+# Console writes from different threads are whole lines, one at a time
+_console_lock = threading.Lock()
+
+# The NDJSON event stream in use, if any; see site.py's --events
+events = None
+
+_counters = Counter()
+_counters_lock = threading.Lock()
+
+def get_depth():
+  return _depth.get()
+
+def _write(text, end='\n'):
+  buffer = _buffer.get()
+  if buffer is not None:
+    buffer.append(text + end)
+  else:
+    with _console_lock:
+      sys.stdout.write(text + end)
 
 def log(text, **kwargs):
-  print("  " * depth + text, **kwargs)
+  _write("  " * get_depth() + text, **kwargs)
+
+def event(kind, **fields):
+  """ Record an event in the event stream, if there is one """
+  if events is not None:
+    events.write(kind, section=list(_sections.get()), **fields)
+
+def count(name, n=1):
+  """ Add to a build counter; see take_counters """
+  with _counters_lock:
+    _counters[name] += n
+
+def take_counters():
+  """ The counters since they were last taken, and reset them """
+  global _counters
+  with _counters_lock:
+    counters, _counters = _counters, Counter()
+  return dict(sorted(counters.items()))
+
+def error(message, **fields):
+  """ Count and record an error, which is expected to be reported to the console separately """
+  count('errors')
+  event('error', message=message, **fields)
 
 @contextmanager
 def log_section(text, multiline=True):
-  global depth
 
   if multiline:
     log(text + " ...")
@@ -17,16 +67,96 @@ def log_section(text, multiline=True):
     log(text + ' ...', end='')
     sys.stdout.flush()
 
-  start = time.time()
-  depth += 1
+  start = time.perf_counter()
+  depth_token = _depth.set(get_depth() + 1)
+  sections_token = _sections.set(_sections.get() + (text,))
+  ok = False
 
-  yield log
+  try:
+    yield log
+    ok = True
+  finally:
+    elapsed = time.perf_counter() - start
+    _sections.reset(sections_token)
+    _depth.reset(depth_token)
+    event('section', name=text, seconds=round(elapsed, 6), ok=ok)
 
-  depth -= 1
-  elapsed = time.time() - start
+    outcome = "done!" if ok else "failed!"
+    if multiline:
+      log(f"... {outcome} [{elapsed:.2f}s]")
+    else:
+      _write(f" {outcome} [{elapsed:.2f}s]")
 
-  if multiline:
-    log(f"... done! [{elapsed:.2f}s]")
-  else:
-    print(f" done! [{elapsed:.2f}s]")
+@contextmanager
+def recorded(kind, **fields):
+  """
+  Record an event for a block of work, such as a build, with how long it
+  took, whether it succeeded, and the counters it added to
+  """
+  take_counters()
+  event(f'{kind}-start', **fields)
+  start = time.perf_counter()
+  outcome = {'ok': False}
+  try:
+    yield
+    outcome['ok'] = True
+  except Exception as e:
+    outcome['error'] = f"{type(e).__name__}: {e}"
+    raise
+  finally:
+    seconds = round(time.perf_counter() - start, 6)
+    event(kind, **fields, **outcome, seconds=seconds, counters=take_counters())
+    if events is not None:
+      events.flush()
+
+@contextmanager
+def buffered():
+  """
+  Collect all log output of the current context and print it in one go
+  upon exit. Used to keep the logs of concurrent builds from interleaving.
+  """
+  buffer = []
+  token = _buffer.set(buffer)
+  try:
+    yield
+  finally:
+    _buffer.reset(token)
+    _write(''.join(buffer), end='')
+    sys.stdout.flush()
+
+def in_context(f):
+  """
+  Wrap f to run in a copy of the current context, wherever it's called.
+  Work handed to other threads keeps the nesting of the code that handed
+  it over this way. Each call gets its own copy, so calls may overlap.
+  """
+  context = contextvars.copy_context()
+  return lambda *args, **kwargs: context.copy().run(f, *args, **kwargs)
+
+class EventStream:
+  """ Writes events as newline-delimited JSON, appending to a file """
+
+  def __init__(self, path):
+    self.lock = threading.Lock()
+    self.origin = time.perf_counter()
+    self.file = open(path, 'a')
+
+  def write(self, kind, **fields):
+    record = {
+      'event': kind,
+      'time': round(time.time(), 6),
+      'elapsed': round(time.perf_counter() - self.origin, 6),
+      'thread': threading.get_ident(),
+      **fields,
+    }
+    line = json.dumps(record, default=str) + '\n'
+    with self.lock:
+      self.file.write(line)
+
+  def flush(self):
+    with self.lock:
+      self.file.flush()
 
+  def close(self):
+    with self.lock:
+      self.file.close()
@@ -0,0 +1,93 @@
+"""
+Conservative minifiers for the text files of the site.
+
+These only remove what is certainly insignificant: comments and
+indentation, and whitespace around punctuation in CSS. Anything they
+are unsure about is left as it is.
+"""
+
+import re
+
+_css_token = re.compile(
+  r'(?P<string>"(?:[^"\\\n]|\\.)*"|\'(?:[^\'\\\n]|\\.)*\')'
+  r'|(?P<comment>/\*(?!!).*?\*/)'
+  r'|(?P<space>\s+)',
+  re.S,
+)
+
+# Whitespace next to these is insignificant in CSS
+_css_after = set('{};,>:(')
+_css_before = set('{};,>)')
+
+def minify_css(text):
+  def strip_comment(match):
+    # Replaced by a space rather than nothing, since a comment separates tokens
+    return ' ' if match.group('comment') else match.group(0)
+
+  def squash_space(match):
+    if not match.group('space'):
+      return match.group(0)
+    before = match.string[match.start() - 1] if match.start() > 0 else None
+    after = match.string[match.end()] if match.end() < len(match.string) else None
+    if before is None or after is None or before in _css_after or after in _css_before:
+      return ''
+    return ' '
+
+  text = _css_token.sub(strip_comment, text)
+  return _css_token.sub(squash_space, text)
+
+def minify_js(text):
+  """
+  Remove indentation, trailing whitespace and blank lines.
+  Line breaks are kept, so automatic semicolon insertion is unaffected.
+  Scripts containing template literals or line continuations, where
+  whitespace may be part of a string, are returned unchanged.
+  """
+  lines = text.split('\n')
+  if '`' in text or any(line.rstrip().endswith('\\') for line in lines):
+    return text
+  return '\n'.join(line.strip() for line in lines if line.strip()) + '\n'
+
+_html_token = re.compile(
+  r'(?P<verbatim><(?P<tag>pre|textarea|code)\b.*?</(?P=tag)\s*>)'
+  r'|(?P<script_open><script\b[^>]*>)(?P<script>.*?)(?P<script_close></script\s*>)'
+  r'|(?P<style_open><style\b[^>]*>)(?P<style>.*?)(?P<style_close></style\s*>)'
+  # Conditional comments, and those marked with '!', are kept
+  r'|(?P<comment><!--(?![\[!]).*?-->)(?P<after_comment>[ \t\r\n]*)'
+  r'|(?P<space>[ \t\r]*\n\s*)',
+  re.S | re.I,
+)
+
+def minify_html(text):
+  """
+  Remove comments and indentation. Runs of whitespace spanning lines
+  become a single line break, which renders the same as before.
+  The contents of <pre>, <textarea> and <code> (which the site's
+  stylesheet gives white-space: pre-wrap) are left alone; those of
+  <script> and <style> are minified as JavaScript and CSS.
+  """
+  def replace(match):
+    if match.group('script_open'):
+      return match.group('script_open') + minify_js(match.group('script')).strip('\n') + match.group('script_close')
+    if match.group('style_open'):
+      return match.group('style_open') + minify_css(match.group('style')) + match.group('style_close')
+    if match.group('comment'):
+      # Whitespace after a comment may separate words, so keep the least of it
+      after = match.group('after_comment')
+      return '\n' if '\n' in after else after[:1]
+    if match.group('space'):
+      return '\n'
+    return match.group(0)
+
+  return _html_token.sub(replace, text)
+
+minifiers = {
+  '.css': minify_css,
+  '.js': minify_js,
+  '.html': minify_html,
+}
+
+def minify(suffix, text):
+  """ Minify text, given the suffix of the file it is for; unknown kinds of file are returned unchanged """
+  minifier = minifiers.get(suffix)
+  return text if minifier is None else minifier(text)
@@ -0,0 +1,92 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+from pathlib import Path
+
+from .globals import build_target
+from .minify import minify
+from .log import count
+from . import images
+
+# Permissions for newly created outputs, as open() would give them
+_umask = os.umask(0)
+os.umask(_umask)
+new_file_mode = 0o666 & ~_umask
+
+
+class OutputManifest:
+  """ The outputs that changed during one build, with their content hashes """
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.changed = {}
+    self.unchanged = 0
+
+  def record(self, path, digest, *, changed):
+    with self.lock:
+      if changed:
+        self.changed[str(Path(path).relative_to(build_target))] = digest
+      else:
+        self.unchanged += 1
+
+  def save(self, path):
+    with open(path, 'w') as f:
+      json.dump(self.changed, f, indent=1, sort_keys=True)
+
+
+# The manifest of the build in progress, if any; see site.py
+manifest = None
+
+# Whether to minify text outputs as they are written; see site.py's --optimize
+minify_outputs = False
+
+# Whether to give the images in HTML outputs responsive variants; see py/images.py
+responsive_images = False
+
+
+def write_output(path, content):
+  """
+  Write content (str or bytes) to path, unless the file already holds
+  exactly that content, in which case it is left alone, mtime and all.
+  Writes are atomic: readers see either the old or the new file, never
+  a partial one. Returns whether the file was written.
+  """
+  path = Path(path)
+  if responsive_images and isinstance(content, str) and path.suffix == '.html':
+    content = images.responsive_images(content, path)
+  if minify_outputs and isinstance(content, str):
+    content = minify(path.suffix, content)
+  data = content.encode() if isinstance(content, str) else content
+  digest = hashlib.sha256(data).hexdigest()
+
+  try:
+    stat = path.stat()
+  except FileNotFoundError:
+    stat = None
+
+  # Only read the existing file if it could possibly be the same
+  if stat is not None and stat.st_size == len(data):
+    with open(path, 'rb') as f:
+      if hashlib.sha256(f.read()).hexdigest() == digest:
+        if manifest is not None:
+          manifest.record(path, digest, changed=False)
+        count('outputs_unchanged')
+        return False
+
+  fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.', suffix='.tmp')
+  try:
+    with os.fdopen(fd, 'wb') as f:
+      f.write(data)
+    os.chmod(tmp_path, stat.st_mode & 0o7777 if stat is not None else new_file_mode)
+    os.replace(tmp_path, path)
+  except BaseException:
+    os.unlink(tmp_path)
+    raise
+
+  if manifest is not None:
+    manifest.record(path, digest, changed=True)
+  count('outputs_written')
+  count('bytes_written', len(data))
+  return True
@@ -1,5 +1,8 @@
+import os
+import pickle
+import hashlib
+import threading
 from pathlib import Path
-import frontmatter
 
 from .globals import build_target
 
@@ -63,6 +66,10 @@ def parse_item(item_path: Path):
   is expeected to adhere to a particular format which I will not
   mention in this docstring--read the function.
   """
+  # Imported here since it's slow to import, and
+  # ParseCache usually makes parsing unnecessary
+  import frontmatter
+
   abs_item_path = item_path.resolve()
 
   with open(abs_item_path) as f:
@@ -101,7 +108,8 @@ def parse_item(item_path: Path):
     # A list of paths to files or directories
     # Documents all the files that 'belong' to this item
     # On site rebuild, an item will only be rebuilt if any
-    # of the files in its 'files' attribute has changed.
+    # of the files in its 'files' attribute has changed, or if
+    # the metadata of other items that its build read has changed.
     # Defaults to a list containing only the item file itself.
     'files': optionally(
       list_of(lambda path: (item_path.parent / path).resolve()),
@@ -154,3 +162,61 @@ def parse_item(item_path: Path):
   return item
 
 
+class ParseCache:
+  """
+  On-disk cache of parsed items, so that unchanged items don't have
+  their frontmatter parsed again on every build.
+
+  Entries are keyed by item path and hold the file's size, mtime and
+  content hash. If the size and mtime match, the cached item is used
+  without reading the file; otherwise the file is read and only parsed
+  if its hash differs. The cache is discarded wholesale if this module
+  changes, since that may change how items are parsed.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.lock = threading.Lock()
+    self.version = hashlib.sha256(Path(__file__).read_bytes()).hexdigest()
+    self.entries = {}
+    try:
+      with open(path, 'rb') as f:
+        version, entries = pickle.load(f)
+      if version == self.version:
+        self.entries = entries
+    except (FileNotFoundError, EOFError, ValueError, pickle.UnpicklingError):
+      pass
+
+  def parse(self, item_path: Path):
+    """ Like parse_item, but cached """
+    key = str(item_path)
+    stat = os.stat(item_path)
+
+    with self.lock:
+      entry = self.entries.get(key)
+
+    if entry is not None and entry[:2] == (stat.st_size, stat.st_mtime_ns):
+      return {**entry[3]}
+
+    with open(item_path, 'rb') as f:
+      digest = hashlib.sha256(f.read()).hexdigest()
+
+    if entry is not None and entry[2] == digest:
+      item = entry[3]
+    else:
+      item = parse_item(item_path)
+
+    with self.lock:
+      self.entries[key] = (stat.st_size, stat.st_mtime_ns, digest, item)
+    return {**item}
+
+  def save(self):
+    # The cache lives in the build directory, which may not exist
+    # yet, e.g. when listing unindexed items before the first build
+    if not self.path.parent.is_dir():
+      return
+    with self.lock:
+      # Forget items which no longer exist
+      entries = {key: entry for key, entry in self.entries.items() if os.path.exists(key)}
+      with open(self.path, 'wb') as f:
+        pickle.dump((self.version, entries), f, protocol=pickle.HIGHEST_PROTOCOL)
@@ -0,0 +1,140 @@
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+from .log import log_section, log, count
+
+# The profiler in use, if any; see site.py's --profile
+active = None
+
+_local = threading.local()
+
+
+def payload_size(item):
+  payload = item.get('payload') if isinstance(item, dict) else None
+  return len(payload.encode()) if isinstance(payload, str) else 0
+
+
+def cache_hit():
+  """ Note that the current build stage was able to use a cached result """
+  count('cache_hits')
+  if getattr(_local, 'hits', None) is not None:
+    _local.hits += 1
+
+
+@contextmanager
+def profiling_item(name):
+  """ Attribute the stages run within this block to the named item """
+  _local.item = name
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    _local.item = None
+    if active is not None:
+      active.add_item(name, start, time.perf_counter())
+
+
+def run_stage(name, f, item, ctx):
+  """ Run one stage of a build chain, recording it if profiling """
+  if active is None:
+    return f(item, ctx)
+
+  bytes_in = payload_size(item)
+  _local.hits = 0
+  # Nothing comes out of a stage that raised
+  result = None
+  start = time.perf_counter()
+  try:
+    result = f(item, ctx)
+  finally:
+    end = time.perf_counter()
+    hits, _local.hits = _local.hits, None
+    active.add_stage(
+      item=getattr(_local, 'item', None),
+      stage=name,
+      start=start,
+      end=end,
+      bytes_in=bytes_in,
+      bytes_out=payload_size(result),
+      cache_hits=hits,
+    )
+  return result
+
+
+class Profiler:
+  """ Records how long each stage of each item's build chain takes """
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.origin = time.perf_counter()
+    self.stages = []
+    self.items = []
+
+  def add_stage(self, **record):
+    record['thread'] = threading.get_ident()
+    with self.lock:
+      self.stages.append(record)
+
+  def add_item(self, name, start, end):
+    with self.lock:
+      self.items.append({
+        'item': name,
+        'start': start,
+        'end': end,
+        'thread': threading.get_ident(),
+      })
+
+  def report(self, *, top=10):
+    """ Log the stages and items which took the longest """
+
+    def totals(key):
+      result = {}
+      for record in self.stages:
+        total = result.setdefault(record[key], {'time': 0, 'count': 0, 'bytes_in': 0, 'bytes_out': 0, 'cache_hits': 0})
+        total['time'] += record['end'] - record['start']
+        total['count'] += 1
+        total['bytes_in'] += record['bytes_in']
+        total['bytes_out'] += record['bytes_out']
+        total['cache_hits'] += record['cache_hits']
+      return sorted(result.items(), key=lambda kv: kv[1]['time'], reverse=True)
+
+    for key, title in [('stage', 'Time by build stage'), ('item', 'Time by item')]:
+      with log_section(title):
+        for name, total in totals(key)[:top]:
+          log(
+            f"{total['time']:8.3f}s  {total['count']:4}x  "
+            f"{total['bytes_in']:>9}B in  {total['bytes_out']:>9}B out  "
+            f"{total['cache_hits']:3} cache hits  {name}"
+          )
+
+  def write_trace(self, path):
+    """
+    Write the recorded stages in the Chrome trace event format,
+    for viewing in chrome://tracing or Perfetto
+    """
+    us = lambda t: round((t - self.origin) * 1e6)
+    events = [
+      {
+        'name': record['item'], 'cat': 'item', 'ph': 'X',
+        'ts': us(record['start']), 'dur': us(record['end']) - us(record['start']),
+        'pid': 1, 'tid': record['thread'],
+      }
+      for record in self.items
+    ] + [
+      {
+        'name': record['stage'], 'cat': 'stage', 'ph': 'X',
+        'ts': us(record['start']), 'dur': us(record['end']) - us(record['start']),
+        'pid': 1, 'tid': record['thread'],
+        'args': {
+          'item': record['item'],
+          'bytes_in': record['bytes_in'],
+          'bytes_out': record['bytes_out'],
+          'cache_hits': record['cache_hits'],
+        },
+      }
+      for record in self.stages
+    ]
+    with open(path, 'w') as f:
+      json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
@@ -0,0 +1,105 @@
+import re
+from pathlib import Path
+
+from .globals import build_target
+from .log import log_section, log
+from .scan import scan_files
+from .util import shell_exec, hash_paths
+
+sass_suffixes = ['.sass', '.scss']
+
+_rule = re.compile(r'^\s*@(?:import|use|forward)\s+(.*)$')
+_quoted = re.compile(r'["\']([^"\']+)["\']')
+
+def imported_names(path: Path):
+  """ The names of the stylesheets that a sass file imports, uses or forwards """
+  names = []
+  with open(path, 'r', errors='replace') as f:
+    for line in f:
+      match = _rule.match(line)
+      if not match:
+        continue
+      rest = match.group(1).strip().rstrip(';')
+      if rest.startswith('url('):
+        continue
+      # The indented syntax allows unquoted names
+      quoted = _quoted.findall(rest)
+      candidates = quoted or [name.strip() for name in rest.split(',')]
+      # Drop 'as' and 'with' clauses of @use
+      names.extend(name.split()[0] for name in candidates if name.strip())
+  return names
+
+def resolve_import(name, directory: Path):
+  """
+  The file within the build that an import refers to, following sass's
+  rules: partials start with '_', and a directory imports its index.
+  Returns None for imports of plain CSS, URLs and built-in modules.
+  """
+  if name.startswith(('sass:', 'http://', 'https://', '//')) or name.endswith('.css'):
+    return None
+  base = directory / name
+  stems = [base, base.with_name('_' + base.name), base / 'index', base / '_index']
+  for stem in stems:
+    candidates = [stem] if stem.suffix in sass_suffixes else [stem.with_name(stem.name + suffix) for suffix in sass_suffixes]
+    for candidate in candidates:
+      if candidate.is_file():
+        return candidate.resolve()
+  return None
+
+def dependency_graph(sass_files):
+  """ Map each sass file to the set of sass files it imports directly """
+  return {
+    path: {
+      resolved for resolved in (resolve_import(name, path.parent) for name in imported_names(path))
+      if resolved is not None
+    }
+    for path in sass_files
+  }
+
+def inputs_of(path, graph):
+  """ The given sass file and everything it imports, transitively """
+  seen = set()
+  stack = [path]
+  while stack:
+    current = stack.pop()
+    if current in seen:
+      continue
+    seen.add(current)
+    stack.extend(graph.get(current, ()))
+  return sorted(seen)
+
+def compile_sass(*, cache):
+  """
+  Compile each sass stylesheet in the build to CSS alongside it.
+  A stylesheet is only compiled if it or anything it imports changed since
+  it was last compiled, or if its CSS is missing. All stylesheets needing
+  compilation are compiled by a single invocation of sass.
+  Partials (files starting with '_') are not compiled themselves.
+  """
+  sass_files = [path.resolve() for path in scan_files(build_target, suffix=tuple(sass_suffixes))]
+  graph = dependency_graph(sass_files)
+  entrypoints = sorted(path for path in sass_files if not path.name.startswith('_'))
+
+  previous = cache.get('_sass')
+  if not isinstance(previous, dict):
+    previous = {}
+
+  digests = {}
+  stale = []
+  for path in entrypoints:
+    rel = str(path.relative_to(build_target))
+    digests[rel] = hash_paths(inputs_of(path, graph))
+    if previous.get(rel) != digests[rel] or not path.with_suffix('.css').is_file():
+      stale.append(path)
+
+  if not stale:
+    log("Sass not modified since last build")
+  else:
+    with log_section(f"Compiling {len(stale)} of {len(entrypoints)} sass stylesheet(s)", multiline=False):
+      # Removing the old CSS makes --update compile even if timestamps say otherwise
+      for path in stale:
+        path.with_suffix('.css').unlink(missing_ok=True)
+      pairs = ' '.join(f'"{path}":"{path.with_suffix(".css")}"' for path in stale)
+      shell_exec(f'cd "{build_target}" && sass --quiet --update {pairs}')
+
+  cache.record('_sass', digests)
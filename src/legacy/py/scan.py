@@ -0,0 +1,70 @@
+import os
+import fnmatch
+from pathlib import Path
+
+# Never worth looking inside
+default_ignore = [
+  '.git',
+  '.sass-cache',
+  '__pycache__',
+  'node_modules',
+  '_cache',
+]
+
+# File listing extra patterns to ignore, one per line, in the scanned directory
+ignore_file_name = '.siteignore'
+
+def load_ignore_rules(directory: Path):
+  """
+  The ignore patterns for a directory: the defaults plus any in its .siteignore.
+  Patterns are shell-style, e.g. 'full' or 'assets/papers/*/figures', and are
+  matched against both the name and the path relative to the directory.
+  Blank lines and lines starting with '#' are skipped.
+  """
+  rules = list(default_ignore)
+  try:
+    with open(directory / ignore_file_name, 'r') as f:
+      for line in f:
+        line = line.strip()
+        if line and not line.startswith('#'):
+          rules.append(line.rstrip('/'))
+  except FileNotFoundError:
+    pass
+  return rules
+
+def scan_files(directory: Path, *, suffix, ignore=None):
+  """
+  Yield the paths of all files under `directory` whose names end in `suffix`,
+  as they are found. Ignored directories are not descended into at all.
+  Entries are visited in name order, so results are deterministic.
+  """
+  if ignore is None:
+    ignore = load_ignore_rules(directory)
+
+  def is_ignored(name, rel_path):
+    return any(
+      fnmatch.fnmatchcase(name, rule) or fnmatch.fnmatchcase(rel_path, rule)
+      for rule in ignore
+    )
+
+  stack = [Path(directory)]
+  while stack:
+    current = stack.pop()
+    try:
+      with os.scandir(current) as it:
+        entries = sorted(it, key=lambda entry: entry.name)
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+      continue
+
+    subdirs = []
+    for entry in entries:
+      rel_path = os.path.relpath(entry.path, directory)
+      if is_ignored(entry.name, rel_path):
+        continue
+      if entry.is_dir():
+        subdirs.append(Path(entry.path))
+      elif entry.name.endswith(suffix) and entry.is_file():
+        yield Path(entry.path)
+
+    # Depth-first, in name order
+    stack.extend(reversed(subdirs))
@@ -0,0 +1,174 @@
+"""
+Full-text search index of the indexed items, built incrementally.
+
+The index is written to build/search/ for use by client-side search:
+  docs.json     [[title, href, description], ...], indexed by document id;
+                null where an id is currently unused
+  <shard>.json  {term: [[document id, weight], ...], ...} for the terms
+                beginning with the shard's name, heaviest first
+Terms are lowercased words of two or more characters. A term's shard is
+named after its first two characters, with any character other than
+a-z and 0-9 replaced by '_'.
+
+Weights count occurrences, with those in titles, tags and descriptions
+counting for more than those in an item's content.
+
+Only the items that were built are re-indexed: the terms of each
+document are kept in cache_dir, so that the shards holding an item's old
+and new terms can be updated without looking at any other item.
+"""
+
+import os
+import re
+import html
+import json
+import threading
+
+from .globals import build_target, cache_dir
+from .output import write_output
+
+search_dir = build_target / 'search'
+search_cache_dir = cache_dir / 'search'
+
+field_weights = {'title': 10, 'tags': 5, 'description': 3, 'content': 1}
+
+_word = re.compile(r'\w{2,}')
+_hidden = re.compile(r'<(script|style)\b.*?</\1\s*>', re.S | re.I)
+_tag = re.compile(r'<[^>]*>')
+
+def html_text(markup):
+  """ The text of some HTML """
+  return html.unescape(_tag.sub(' ', _hidden.sub(' ', markup)))
+
+def item_terms(item):
+  """ Map each term in a built item to its weight """
+  content = item.get('content', item.get('payload'))
+  fields = {
+    'title': item['title'],
+    'tags': ' '.join(item['tags']),
+    'description': item['description'],
+    'content': html_text(content) if isinstance(content, str) else '',
+  }
+  terms = {}
+  for field, text in fields.items():
+    for word in _word.findall(text.casefold()):
+      terms[word] = terms.get(word, 0) + field_weights[field]
+  return terms
+
+def shard_name(term):
+  return re.sub(r'[^a-z0-9]', '_', term[:2])
+
+def load_json(path, default):
+  try:
+    with open(path, 'r') as f:
+      return json.load(f)
+  except (FileNotFoundError, ValueError):
+    return default
+
+def save_json(path, value):
+  """ Write a file of the index, as served with the site """
+  path.parent.mkdir(parents=True, exist_ok=True)
+  write_output(path, json.dumps(value, separators=(',', ':'), sort_keys=True))
+
+def save_cache_json(path, value):
+  """ Write one of the files kept to update the index, which aren't part of the site """
+  path.parent.mkdir(parents=True, exist_ok=True)
+  tmp_path = path.with_name(path.name + '.tmp')
+  with open(tmp_path, 'w') as f:
+    json.dump(value, f, separators=(',', ':'), sort_keys=True)
+  os.replace(tmp_path, path)
+
+class SearchIndex:
+  """
+  The search index, as updated by one build.
+  Built items are added with `update` as they are built, from any thread;
+  `finish` then writes out the changes.
+  """
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.ids_f = search_cache_dir / 'ids.json'
+    # Map from item location to document id
+    self.ids = load_json(self.ids_f, {})
+    self.pending = {}
+
+  def has(self, loc):
+    """ Is the item at this location in the index? """
+    return str(loc) in self.ids
+
+  def update(self, loc, item):
+    """ Note a newly built item, to be (re-)indexed by `finish` """
+    doc = [item['title'], item['computed_href'], item['description']]
+    terms = item_terms(item)
+    with self.lock:
+      self.pending[str(loc)] = (doc, terms)
+
+  def terms_f(self, doc_id):
+    return search_cache_dir / 'terms' / f'{doc_id}.json'
+
+  def finish(self, locs):
+    """
+    Write out the changes to the index, given the locations of all the
+    items that should be in it. Returns the number of documents changed.
+    """
+    locs = set(map(str, locs))
+    removed = set(self.ids) - locs
+    updated = {loc: entry for loc, entry in self.pending.items() if loc in locs}
+    if not removed and not updated:
+      return 0
+
+    docs = load_json(search_dir / 'docs.json', [])
+    # Postings to remove, and to add, by shard
+    remove = {}
+    add = {}
+
+    def remove_doc(loc):
+      doc_id = self.ids[loc]
+      for term in load_json(self.terms_f(doc_id), {}):
+        remove.setdefault(shard_name(term), set()).add((term, doc_id))
+      return doc_id
+
+    free_ids = []
+    for loc in sorted(removed):
+      doc_id = remove_doc(loc)
+      self.terms_f(doc_id).unlink(missing_ok=True)
+      docs[doc_id] = None
+      del self.ids[loc]
+      free_ids.append(doc_id)
+
+    for loc, (doc, terms) in sorted(updated.items()):
+      if loc in self.ids:
+        doc_id = remove_doc(loc)
+      else:
+        # Reuse ids, so that docs.json doesn't grow without bound
+        doc_id = free_ids.pop(0) if free_ids else len(docs)
+        self.ids[loc] = doc_id
+      if doc_id == len(docs):
+        docs.append(None)
+      docs[doc_id] = doc
+      for term, weight in terms.items():
+        add.setdefault(shard_name(term), []).append((term, doc_id, weight))
+      save_cache_json(self.terms_f(doc_id), terms)
+
+    for shard in sorted(remove.keys() | add.keys()):
+      shard_f = search_dir / f'{shard}.json'
+      postings = load_json(shard_f, {})
+      for term, doc_id in remove.get(shard, ()):
+        if term in postings:
+          postings[term] = [posting for posting in postings[term] if posting[0] != doc_id]
+      for term, doc_id, weight in add.get(shard, ()):
+        postings.setdefault(term, []).append([doc_id, weight])
+      postings = {
+        term: sorted(term_postings, key=lambda posting: (-posting[1], posting[0]))
+        for term, term_postings in postings.items() if term_postings
+      }
+      if postings:
+        save_json(shard_f, postings)
+      else:
+        shard_f.unlink(missing_ok=True)
+
+    while docs and docs[-1] is None:
+      docs.pop()
+    save_json(search_dir / 'docs.json', docs)
+    save_cache_json(self.ids_f, self.ids)
+    return len(removed) + len(updated)
@@ -0,0 +1,296 @@
+import os
+import re
+import shutil
+import threading
+import email.utils
+import functools
+from http import HTTPStatus
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+# Path of the endpoint that pages listen on for live-reload notifications
+LIVE_RELOAD_PATH = '/__live-reload'
+
+LIVE_RELOAD_SCRIPT = f"""
+<script>
+  new EventSource('{LIVE_RELOAD_PATH}').onmessage = () => location.reload();
+</script>
+""".encode()
+
+# Precompressed siblings (see py/assets.py) to look for, in order of preference
+PRECOMPRESSED = [('.br', 'br'), ('.gz', 'gzip')]
+
+
+class Reloader:
+  """ Lets threads wait until the next time the site is rebuilt """
+
+  def __init__(self):
+    self.condition = threading.Condition()
+    self.generation = 0
+
+  def notify(self):
+    with self.condition:
+      self.generation += 1
+      self.condition.notify_all()
+
+  def wait(self, generation, timeout):
+    """ Wait until the generation differs from the given one, and return the current generation """
+    with self.condition:
+      self.condition.wait_for(lambda: self.generation != generation, timeout=timeout)
+      return self.generation
+
+
+class Handler(SimpleHTTPRequestHandler):
+  """
+  Static file handler for the dev server.
+  On top of SimpleHTTPRequestHandler, supports ETags, single byte
+  ranges, precompressed files, and injecting a live-reload script
+  into HTML pages.
+  """
+
+  # Set by make_server
+  reloader = None
+
+  def end_headers(self):
+    # Always revalidate; the files change whenever the site is rebuilt
+    self.send_header('Cache-Control', 'no-cache')
+    super().end_headers()
+
+  def do_GET(self):
+    if self.reloader is not None and self.path == LIVE_RELOAD_PATH:
+      self.stream_reloads()
+    else:
+      super().do_GET()
+
+  def stream_reloads(self):
+    # Server-sent events; send a message after each rebuild
+    self.send_response(HTTPStatus.OK)
+    self.send_header('Content-Type', 'text/event-stream')
+    self.end_headers()
+    generation = self.reloader.generation
+    try:
+      while True:
+        new_generation = self.reloader.wait(generation, timeout=15)
+        if new_generation != generation:
+          self.wfile.write(b'data: reload\n\n')
+        else:
+          # keep-alive comment
+          self.wfile.write(b': \n\n')
+        self.wfile.flush()
+        generation = new_generation
+    except (BrokenPipeError, ConnectionResetError):
+      pass
+
+  def send_head(self):
+    path = self.translate_path(self.path)
+    if os.path.isdir(path) and self.path.split('?', 1)[0].endswith('/'):
+      path = os.path.join(path, 'index.html')
+    if not os.path.isfile(path):
+      # Let the base class handle redirects, directory listings and 404s
+      return super().send_head()
+
+    ctype = self.guess_type(path)
+    inject = self.reloader is not None and ctype == 'text/html'
+    # Pages being injected into must be read uncompressed
+    encoding = None if inject else self.precompressed(path)
+    if encoding is not None:
+      suffix, encoding = encoding
+      path += suffix
+
+    try:
+      f = open(path, 'rb')
+    except OSError:
+      self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+      return None
+
+    stat = os.fstat(f.fileno())
+    etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+    last_modified = self.date_time_string(stat.st_mtime)
+
+    if self.not_modified(etag, stat.st_mtime):
+      f.close()
+      self.send_response(HTTPStatus.NOT_MODIFIED)
+      self.send_header('ETag', etag)
+      self.send_header('Last-Modified', last_modified)
+      self.send_header('Vary', 'Accept-Encoding')
+      self.end_headers()
+      return None
+
+    self.range_length = None
+
+    if inject:
+      # Serve the whole page, with the live-reload script added
+      with f:
+        body = f.read()
+      body = inject_before(body, b'</body>', LIVE_RELOAD_SCRIPT)
+      self.send_response(HTTPStatus.OK)
+      self.send_header('Content-Type', ctype)
+      self.send_header('Content-Length', str(len(body)))
+      self.send_header('ETag', etag)
+      self.send_header('Last-Modified', last_modified)
+      self.end_headers()
+      return BytesReader(body)
+
+    byte_range = self.requested_range(stat.st_size, etag)
+    if byte_range == 'unsatisfiable':
+      f.close()
+      self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+      self.send_header('Content-Range', f'bytes */{stat.st_size}')
+      self.end_headers()
+      return None
+
+    if byte_range is None:
+      self.send_response(HTTPStatus.OK)
+      self.send_header('Content-Length', str(stat.st_size))
+    else:
+      start, end = byte_range
+      f.seek(start)
+      self.range_length = end - start + 1
+      self.send_response(HTTPStatus.PARTIAL_CONTENT)
+      self.send_header('Content-Range', f'bytes {start}-{end}/{stat.st_size}')
+      self.send_header('Content-Length', str(self.range_length))
+
+    self.send_header('Content-Type', ctype)
+    if encoding is not None:
+      self.send_header('Content-Encoding', encoding)
+    self.send_header('Vary', 'Accept-Encoding')
+    self.send_header('Accept-Ranges', 'bytes')
+    self.send_header('ETag', etag)
+    self.send_header('Last-Modified', last_modified)
+    self.end_headers()
+    return f
+
+  def precompressed(self, path):
+    """
+    The (suffix, encoding) of a precompressed sibling of the file at path
+    to send instead of it, if there is one the client accepts.
+    Siblings are only used if they have the same mtime as the file,
+    which means that they are up to date with it.
+    """
+    accepted = set()
+    for part in self.headers.get('Accept-Encoding', '').split(','):
+      name, *params = [piece.strip() for piece in part.split(';')]
+      if not any(re.fullmatch(r'q=0(\.0*)?', param) for param in params):
+        accepted.add(name.lower())
+
+    try:
+      mtime = os.stat(path).st_mtime_ns
+    except OSError:
+      return None
+
+    for suffix, encoding in PRECOMPRESSED:
+      if encoding not in accepted:
+        continue
+      try:
+        if os.stat(path + suffix).st_mtime_ns == mtime:
+          return suffix, encoding
+      except OSError:
+        pass
+    return None
+
+  def not_modified(self, etag, mtime):
+    if_none_match = self.headers.get('If-None-Match')
+    if if_none_match is not None:
+      return if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]
+
+    if_modified_since = self.headers.get('If-Modified-Since')
+    if if_modified_since is not None:
+      try:
+        since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+      except (TypeError, ValueError, IndexError, OverflowError):
+        return False
+      return int(mtime) <= since
+
+    return False
+
+  def requested_range(self, size, etag):
+    """
+    Return the (start, end) byte range requested, with `end` inclusive,
+    or None to send the whole file, or 'unsatisfiable'.
+    Only single ranges are supported; requests for multiple ranges get the whole file.
+    """
+    header = self.headers.get('Range')
+    if header is None:
+      return None
+
+    # If-Range: only honour the range if the file is unchanged
+    if_range = self.headers.get('If-Range')
+    if if_range is not None and if_range.strip() != etag:
+      return None
+
+    match = re.fullmatch(r'\s*bytes=(\d*)-(\d*)\s*', header)
+    if not match or match.group(1) == match.group(2) == '':
+      return None
+
+    first, last = match.groups()
+    if first == '':
+      # suffix range: the last N bytes
+      length = int(last)
+      if length == 0:
+        return 'unsatisfiable'
+      start, end = max(size - length, 0), size - 1
+    else:
+      start = int(first)
+      end = min(int(last), size - 1) if last != '' else size - 1
+      if start > end:
+        return 'unsatisfiable' if start >= size else None
+
+    return start, end
+
+  def copyfile(self, source, outputfile):
+    if self.range_length is None:
+      shutil.copyfileobj(source, outputfile)
+      return
+
+    remaining = self.range_length
+    while remaining > 0:
+      chunk = source.read(min(remaining, 1 << 16))
+      if not chunk:
+        break
+      outputfile.write(chunk)
+      remaining -= len(chunk)
+
+
+class BytesReader:
+  """ Minimal file-like object over bytes, as returned from send_head """
+
+  def __init__(self, data):
+    self.data = data
+
+  def read(self, size=-1):
+    if size < 0:
+      size = len(self.data)
+    chunk, self.data = self.data[:size], self.data[size:]
+    return chunk
+
+  def close(self):
+    pass
+
+
+def inject_before(html, marker, snippet):
+  """ Insert a snippet before the last occurrence of a marker, or at the end if there is none """
+  index = html.rfind(marker)
+  if index == -1:
+    return html + snippet
+  return html[:index] + snippet + html[index:]
+
+
+def start_server(directory, *, port, live_reload):
+  """
+  Serve the given directory on localhost in the background.
+  Returns a function to call after each rebuild to notify live-reloading pages.
+  """
+  reloader = Reloader() if live_reload else None
+  handler = functools.partial(
+    type('BoundHandler', (Handler,), {'reloader': reloader}),
+    directory=str(directory),
+  )
+  server = ThreadingHTTPServer(('', port), handler)
+  server.daemon_threads = True
+  thread = threading.Thread(target=server.serve_forever, daemon=True)
+  thread.start()
+  print(f"Serving {directory} at http://localhost:{port}/")
+
+  def notify_reload():
+    if reloader is not None:
+      reloader.notify()
+  return notify_reload
@@ -0,0 +1,108 @@
+import os
+import json
+import fcntl
+import shutil
+from pathlib import Path
+
+from .util import hash_file, path_in_eq_dir
+
+# ioctl request number for cloning a file's extents on Linux
+# (btrfs, xfs, ...); see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+def copy_file(source, target):
+  """
+  Copy a file along with its timestamps and permissions.
+  Uses a reflink where the filesystem supports it, and a plain copy otherwise.
+  """
+  # Remove first; the target may be readonly (e.g. in .git folders)
+  if os.path.lexists(target):
+    os.unlink(target)
+
+  with open(source, 'rb') as src, open(target, 'wb') as dst:
+    try:
+      fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    except OSError:
+      shutil.copyfileobj(src, dst)
+
+  shutil.copystat(source, target)
+
+def sync_tree(source: Path, target: Path, *, manifest_f: Path):
+  """
+  Make `target` contain a copy of every file in `source`,
+  copying only files that are new or have changed since the last sync
+  and deleting copies of files that have since been removed from `source`.
+  Files in `target` that did not come from `source` are left alone.
+  Symlinks are followed, so `target` gets copies of what they point to.
+
+  A manifest of synced files is kept in `manifest_f`. A file whose size
+  and mtime match the manifest is skipped without being read; otherwise
+  it is only copied if its content hash differs.
+
+  Returns the set of target paths that were written or removed.
+  """
+  try:
+    with open(manifest_f, 'r') as f:
+      manifest = json.load(f)
+  except (FileNotFoundError, ValueError):
+    manifest = {}
+
+  new_manifest = {}
+  changed = set()
+
+  for dirpath, dirnames, filenames in os.walk(source, followlinks=True):
+    # Don't follow links back into a directory that we're already in
+    dirnames[:] = [
+      name for name in dirnames
+      if not path_in_eq_dir(dirpath, os.path.join(dirpath, name))
+    ]
+    rel_dir = Path(dirpath).relative_to(source)
+    (target / rel_dir).mkdir(parents=True, exist_ok=True)
+
+    for filename in filenames:
+      src = Path(dirpath) / filename
+      dst = target / rel_dir / filename
+      rel = str(rel_dir / filename)
+
+      try:
+        src_stat = src.stat()
+      except FileNotFoundError:
+        # broken symlink
+        continue
+
+      try:
+        dst_stat = dst.stat()
+      except FileNotFoundError:
+        dst_stat = None
+
+      size, mtime = src_stat.st_size, src_stat.st_mtime_ns
+      prev = manifest.get(rel)
+      up_to_date = (
+        dst_stat is not None
+        and dst_stat.st_size == size
+        and dst_stat.st_mtime_ns == mtime
+      )
+
+      if prev is not None and prev[:2] == [size, mtime] and up_to_date:
+        new_manifest[rel] = prev
+        continue
+
+      digest = hash_file(src)
+      if prev is not None and prev[2] == digest and dst_stat is not None and dst_stat.st_size == size:
+        # Only the timestamp changed, e.g. due to a git checkout
+        shutil.copystat(src, dst)
+      else:
+        copy_file(src, dst)
+        changed.add(dst)
+      new_manifest[rel] = [size, mtime, digest]
+
+  for rel in manifest.keys() - new_manifest.keys():
+    dst = target / rel
+    if os.path.lexists(dst):
+      os.unlink(dst)
+      changed.add(dst)
+
+  with open(manifest_f, 'w') as f:
+    json.dump(new_manifest, f)
+
+  return changed
@@ -0,0 +1,99 @@
+import re
+import json
+import hashlib
+
+from .globals import build_target
+from .calc_item_tree import TagIndex, bits
+from .context import fingerprint
+from .log import log_section, log
+from .output import write_output
+from .util import flatten
+from . import assets
+
+tags_dir = build_target / 'tags'
+
+# JSON index of the indexed items and of which tags they have:
+#   {"items": [{"title", "href", "description", "tags"}, ...],
+#    "tags": {tag: [indexes into "items"], ...}}
+tag_index_f = tags_dir / 'index.json'
+
+
+def tag_slug(tag):
+  """
+  The name of a tag's page, without the '.html'. Tags which don't make a
+  clean name as they are get a hash of themselves added, so that names
+  are distinct without needing to know the other tags.
+  """
+  slug = re.sub(r'[^a-z0-9]+', '-', tag.lower()).strip('-')
+  if slug != tag:
+    slug = f"{slug or 'tag'}-{hashlib.sha256(tag.encode()).hexdigest()[:6]}"
+  return slug
+
+
+def tag_href(tag):
+  """ URL of a tag's page """
+  return f'/{tags_dir.relative_to(build_target).as_posix()}/{tag_slug(tag)}.html'
+
+
+def summary(item):
+  """ What tag pages and the tag index show of an item """
+  return {
+    'title': item['title'],
+    'href': item['computed_href'],
+    'description': item['description'],
+    'tags': list(item['tags']),
+  }
+
+
+def build_tag_pages(items, *, cache):
+  """
+  Write a page for each tag listing the items with it, and the tag index.
+  A tag's page is only rebuilt if what it shows of its items changed,
+  or the templates did. Pages of tags that no longer exist are removed.
+  """
+  from .build import load_templates, templates_f
+
+  indexed = [item for item in items if item['indexed']]
+  tags = sorted(set(flatten([item['tags'] for item in indexed])))
+  slugs = {tag: tag_slug(tag) for tag in tags}
+  index = TagIndex(indexed, tags)
+  summaries = [summary(item) for item in indexed]
+  members = {tag: list(bits(index.with_tag[t])) for t, tag in enumerate(tags)}
+
+  with open(templates_f, 'r') as f:
+    templates_source = f.read()
+
+  previous = cache.get('_tags')
+  if not isinstance(previous, dict):
+    previous = {}
+
+  digests = {}
+  stale = []
+  for tag in tags:
+    slug = slugs[tag]
+    digests[slug] = fingerprint([
+      tag,
+      [summaries[i] for i in members[tag]],
+      templates_source,
+      assets.optimization_key(),
+    ])
+    if previous.get(slug) != digests[slug] or not (tags_dir / f'{slug}.html').is_file():
+      stale.append(tag)
+
+  with log_section("Building tag pages"):
+    tags_dir.mkdir(parents=True, exist_ok=True)
+
+    if stale:
+      templates = load_templates(templates_source)
+      for tag in stale:
+        page = templates.tmpl_tag(tag, [summaries[i] for i in members[tag]])
+        write_output(tags_dir / f'{slugs[tag]}.html', page)
+
+    for slug in set(previous) - set(digests):
+      (tags_dir / f'{slug}.html').unlink(missing_ok=True)
+
+    tag_index = {'items': summaries, 'tags': members}
+    write_output(tag_index_f, json.dumps(tag_index, separators=(',', ':'), sort_keys=True))
+    log(f"{len(stale)} of {len(tags)} tag page(s) rebuilt")
+
+  cache.record('_tags', digests)
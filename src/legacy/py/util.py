@@ -1,20 +1,31 @@
 import os
+import queue
 import atexit
+import hashlib
 from pathlib import Path
-import watchdog.events
-import watchdog.observers
 
-def watch_dir(target, callback):
-  """ Watch the target directory and call the decorated function on each change. Blocking. """
+from .globals import build_target
+
+def watch_dir(target, callback, *, debounce=0.2):
+  """
+  Watch the target directory and call `callback` with each batch of changes. Blocking.
+  Events arriving less than `debounce` seconds apart are merged into one batch,
+  so that e.g. an editor saving a file in several steps causes only one call.
+  """
+
+  # Only needed when serving
+  import watchdog.events
+  import watchdog.observers
+
+  events = queue.Queue()
 
   class EventHandler(watchdog.events.FileSystemEventHandler):
     def on_any_event(self, event):
-      callback(event)
+      events.put(event)
 
   # Create observer
   event_handler = EventHandler()
   observer = watchdog.observers.Observer()
-  file_observer = watchdog.observers.Observer()
   observer.schedule(event_handler, target, recursive=True)
 
   # Kill observer on program exit
@@ -22,7 +33,14 @@ def watch_dir(target, callback):
 
   # Start and block
   observer.start()
-  observer.join()
+  while True:
+    batch = [events.get()]
+    while True:
+      try:
+        batch.append(events.get(timeout=debounce))
+      except queue.Empty:
+        break
+    callback(batch)
 
 
 def shell_exec(command):
@@ -39,25 +57,55 @@ def path_in_eq_dir(path, dir):
   return rpath == rdir or rpath.startswith(rdir + os.sep)
 
 
-def was_modified(path: Path, *, since):
-  """
-  Was the file at the given path modified since the given time?
-  e.g. `if modified(path, since=yesterday):`
-  """
+def hash_file(path):
+  """ Hex digest of the contents of a file """
+  digest = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(1 << 16), b''):
+      digest.update(chunk)
+  return digest.hexdigest()
+
 
-  # TODO
-  # Hack to get the index to rebuild every time
-  # since detecting changes to files/ doesn't seem to
-  # be working
-  if 'index' in str(path):
-    return True
+def is_precompressed(path):
+  """ Is this a compressed copy of the file next to it, as written by --optimize (see py/assets.py)? """
+  return path.suffix in ('.gz', '.br') and path.with_suffix('').is_file()
 
-  if since is None:
-    # air on the conservative side
-    return True
 
-  mod_time = path.stat().st_mtime
-  return mod_time > since
+def hash_paths(paths, *, extra=()):
+  """
+  Digest of the contents of the given files and directories,
+  along with any extra strings.
+  Directories are hashed recursively; missing paths are hashed
+  as missing rather than raising. Within directories, compressed
+  copies of files are skipped, since they are written after items
+  are built and only ever duplicate the files they sit next to.
+  Paths are hashed relative to the build directory, so that the
+  digest is the same in any checkout.
+  """
+  digest = hashlib.sha256()
+  name = lambda path: os.path.relpath(path, build_target).encode()
+
+  for string in extra:
+    digest.update(string.encode() + b'\0')
+
+  def add_file(path):
+    digest.update(name(path) + b'\0')
+    with open(path, 'rb') as f:
+      for chunk in iter(lambda: f.read(1 << 16), b''):
+        digest.update(chunk)
+
+  for path in paths:
+    path = Path(path)
+    if path.is_dir():
+      for sub in sorted(path.rglob('*')):
+        if sub.is_file() and not is_precompressed(sub):
+          add_file(sub)
+    elif path.is_file():
+      add_file(path)
+    else:
+      digest.update(name(path) + b'\0<missing>')
+
+  return digest.hexdigest()
 
 
 def flatten(xss):
@@ -1,17 +1,27 @@
 import os
 import time
-import atexit
 import shutil
 import traceback
-import subprocess
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from docopt import docopt
-from py.globals import build_target, build_source, build_time_f
+from py.globals import build_target, build_source, build_cache_f, sync_manifest_f, parse_cache_f, changed_outputs_f, artifact_store_dir, artifact_store_max_size, deploy_state_dir
 import py.log as log_module
+import py.profile as profile
+import py.output as output
+import py.assets as assets
 from py.log import log_section, log
-from py.util import shell_exec, watch_dir, path_in_eq_dir, was_modified
-from py.parse import parse_item
+from py.util import watch_dir, path_in_eq_dir
+from py.parse import ParseCache
 from py.build import build_payloads
+from py.cache import BuildCache
+from py.sync import sync_tree
+from py.scan import scan_files
+from py.sass import compile_sass
+from py.tags import build_tag_pages
+from py.search import SearchIndex
+from py.deploy import deploy
+from py.artifacts import default_store, parse_size, format_size
 
 """
 
@@ -60,16 +70,26 @@ is mostly ignored, and the item denoted from the metadata is added
 to the website index.
 
 Usage:
-  build.py build [--from-scratch]
-  build.py serve [--from-scratch]
+  build.py build [--from-scratch] [--jobs=N] [--optimize] [--profile=FILE] [--events=FILE]
+  build.py serve [--from-scratch] [--jobs=N] [--optimize] [--events=FILE] [--port=PORT] [--live-reload]
+  build.py deploy <destination> [--dry-run] [--force] [--batch-size=N]
   build.py unindexed
+  build.py cache stats
+  build.py cache prune [--max-size=SIZE]
 
 Commands:
   build       Build the website once and exit.
   serve       Build the website once and rebuild when files change. Additionally,
               serve the website on localhost. Given arguments are passed onto
               the resulting `build.py build` calls.
+  deploy      Upload the built website to an rsync destination, such as
+              user@host:/var/www/site/ or a local directory. Only files that
+              changed since the last deploy to that destination are sent.
   unindexed   List all the unindexed items
+  cache       Show the size of the artifact store, which keeps compiled LaTeX
+              so that it survives building from scratch, or evict its least
+              recently used entries. The store is in .artifacts/, or wherever
+              SITE_ARTIFACT_STORE says; it may be shared between clones.
 
 Options:
   --from-scratch    Unconditionally rebuild everything
@@ -77,137 +97,274 @@ Options:
                     they have not changed since the last build.
                     If used with 'serve', will only rebuild the initial build
                     from scratch. Subsequent builds will be incremental.
+  --jobs=N          Build up to N items at the same time [default: 1]
+                    Useful when there are several slow items, such as
+                    LaTeX papers, that would otherwise hold each other up.
+  --optimize        Minify pages and site-wide assets, give the latter
+                    content-hashed URLs so that they can be cached forever,
+                    and write .gz (and, if the brotli package is installed,
+                    .br) siblings of text files for the server to send.
+                    If Pillow is installed, images in pages are also given
+                    resized WebP/AVIF variants, with srcset markup.
+  --profile=FILE    Time every stage of every item's build chain. Prints a
+                    summary and writes a Chrome trace (see chrome://tracing)
+                    of the stages to FILE.
+  --events=FILE     Append a record of each build to FILE as newline-delimited
+                    JSON: the time taken by each section, errors, and a
+                    summary with counters such as items scanned, skipped and
+                    built, and bytes written. For monitoring builds and
+                    comparing them over time.
+  --port=PORT       Port to serve the website on [default: 8000]
+  --live-reload     Make open pages reload themselves after each rebuild
+  --dry-run         List what would be sent and deleted, without deploying
+  --force           Deploy even if it would delete most of the deployed files
+  --batch-size=N    Send at most N files per rsync invocation [default: 1000]
+  --max-size=SIZE   Size to prune the artifact store down to, e.g. 500M.
+                    Defaults to SITE_ARTIFACT_STORE_MAX_SIZE, or 1G.
 
 """
 
 
-def calc_last_build_time():
-  # get the last build time
-
-  if not build_time_f.is_file():
-    return None
-
-  with open(build_time_f, 'r') as f:
-    try:
-      return float(f.read())
-    except ValueError:
-      return None
-
-
-def set_build_time(time):
-  with open(build_time_f, 'w') as f:
-    f.write(str(time))
-
-
-def find_items(directory: Path):
+def find_items(directory: Path, *, cache=None):
   """
   Find all files in a directory that
   end in '.fm'; parse them and return the
   parsed items.
+  Directories matching the ignore rules (see py/scan.py) are skipped.
+  Files are parsed in the background while scanning continues.
+  Parsed items are cached between runs; see ParseCache.
   """
-  items = []
+  if cache is None:
+    cache = ParseCache(parse_cache_f)
   with log_section("Looking for items"):
-    for file_loc in directory.glob('**/*.fm'):
-      log(f"found '{file_loc}'")
-      items.append(parse_item(Path(file_loc)))
+    with ThreadPoolExecutor() as pool:
+      parsing = []
+      for file_loc in scan_files(directory, suffix='.fm'):
+        log(f"found '{file_loc}'")
+        parsing.append(pool.submit(cache.parse, file_loc))
+      items = [future.result() for future in parsing]
     log(f"found {len(items)} items")
+  log_module.count('items_scanned', len(items))
+  cache.save()
   return items
 
 
-def compile_sass(*, last_build_time):
-  sass_files = build_target.glob('**/*.sass')
-  if all(not was_modified(path, since=last_build_time) for path in sass_files):
-    log("Sass not modified since last build")
+class Session:
+  """
+  State kept in memory between the builds made by one run of this
+  program, so that `serve` doesn't reload it from disk on each rebuild
+  """
+
+  def __init__(self):
+    self.parse_cache = None
+    self.build_cache = None
+    # Whether build/ is known to be the result of a build made by this session.
+    # If so, only items touching synced files need to be checked for changes.
+    self.built = False
+
+  def load(self):
+    if self.parse_cache is None:
+      self.parse_cache = ParseCache(parse_cache_f)
+    if self.build_cache is None:
+      self.build_cache = BuildCache(build_cache_f)
+
+  def clear(self):
+    self.__init__()
+
+
+def optimize_assets(*, enabled, cache):
+  """
+  Fingerprint site-wide assets and make pages link to them, if enabled.
+  If not, but the last build was optimized, clear up after it instead.
+  """
+  output.minify_outputs = enabled
+  output.responsive_images = enabled
+  if enabled or cache.get('_optimized'):
+    with log_section("Fingerprinting assets", multiline=False):
+      assets.asset_map = assets.fingerprint_assets(build_target, enabled=enabled)
   else:
-    with log_section("Compiling sass", multiline=False):
-      shell_exec(f'cd "{build_target}" && sass --quiet --update .:.')
+    assets.asset_map = {}
 
 
-def build_site(*, from_scratch):
+def precompress(*, enabled, cache):
+  if enabled or cache.get('_optimized'):
+    with log_section("Precompressing", multiline=False):
+      count = assets.precompress(build_target, enabled=enabled)
+    log(f"{count} file(s) compressed")
+  cache.record('_optimized', enabled)
 
-  # If we encounter an error in the middle of a build, the depth
-  # counter won't reset to 0, so do it at the beginning of
-  # every build
-  log_module.depth = 0
+
+def build_site(*, from_scratch, jobs=1, optimize=False, session=None):
+  if session is None:
+    session = Session()
 
   print("\n============== [ BEGIN BUILD ] ==============\n")
 
-  with log_section('Building site'):
+  # Also records the build, with its counters, in the event stream
+  with log_module.recorded('build', from_scratch=from_scratch, jobs=jobs, optimize=optimize), log_section('Building site'):
 
-    # clone source folder to build folder
-    with log_section(f"Clearing/creating/updating {build_target}", multiline=False):
+    # sync source folder to build folder
+    with log_section(f"Syncing {build_source} into {build_target}", multiline=False):
       # clear if exists
       if os.path.isdir(build_target) and from_scratch:
         shutil.rmtree(build_target)
+        session.clear()
+      build_target.mkdir(parents=True, exist_ok=True)
 
-      # The '/.' ensures that we don't move the source folder into the target folder.
-      # Preserve timestampts so that skipping unmodified stuff works properly.
-      # From https://unix.stackexchange.com/a/180987/126342
-      # The -f flag is needed to handle readonly files in .git folders
-      shell_exec(f'cp -f -r --preserve=timestamps "{build_source}/." "{build_target}"')
+      # Only copies what changed since the last sync
+      changed = sync_tree(build_source, build_target, manifest_f=sync_manifest_f)
+    log(f"{len(changed)} file(s) copied or removed")
 
-    last_build_time = calc_last_build_time()
+    session.load()
+    cache = session.build_cache
+    incremental = session.built
+    session.built = False
 
-    # build items
-    items = find_items(build_target)
-    build_payloads(items, last_build_time=last_build_time)
-
-    compile_sass(last_build_time=last_build_time)
-
-    # Record the build time
-    # Do it last so that if it was unsuccessful we don't
-    # reach this line.
-    # If we recorded the time of a failed build, then
-    # we may mistakenly skip building an item in a following build
-    set_build_time(time.time())
+    # Only parts of the site that built successfully are recorded
+    # in the cache, so save it even if the build fails midway
+    outputs = output.manifest = output.OutputManifest()
+    try:
+      # Sass first, so that the CSS exists to be fingerprinted before pages link to it
+      compile_sass(cache=cache)
+      optimize_assets(enabled=optimize, cache=cache)
+
+      # build items
+      items = find_items(build_target, cache=session.parse_cache)
+      search = SearchIndex()
+      try:
+        build_payloads(
+          items,
+          cache=cache,
+          jobs=jobs,
+          changed=changed if incremental else None,
+          search=search,
+        )
+      finally:
+        # Even if some items failed, since those which were built are recorded
+        # in the cache as such, and won't be rebuilt to be indexed next time
+        with log_section("Updating search index", multiline=False):
+          count = search.finish(
+            item['location'].relative_to(build_target)
+            for item in items if item['indexed']
+          )
+        log(f"{count} document(s) re-indexed")
+      build_tag_pages(items, cache=cache)
+
+      precompress(enabled=optimize, cache=cache)
+    finally:
+      cache.save()
+      store = default_store()
+      if store.added:
+        store.prune(parse_size(artifact_store_max_size))
+      output.manifest = None
+      outputs.save(changed_outputs_f)
+      log(f"{len(outputs.changed)} output(s) written, {outputs.unchanged} unchanged")
+    session.built = True
 
   print("\n============== [ BUILD COMPLETE ] ==============\n")
 
 
 def try_build_site(*args, **kwargs):
+  """ Build the site, reporting rather than raising errors. Return whether the build succeeded. """
   try:
     build_site(*args, **kwargs)
+    return True
   except Exception as e:
     print()
     traceback.print_exc()
     print("\n^^ Exception occured while building site ^^\n")
+    return False
 
 
 def main():
 
   args = docopt(__doc__)
+  jobs = int(args['--jobs'])
+  optimize = args['--optimize']
+  if args['--events']:
+    log_module.events = log_module.EventStream(args['--events'])
 
   if args['build']:
-    build_site(from_scratch=args['--from-scratch'])
+    if args['--profile']:
+      profile.active = profile.Profiler()
+    try:
+      build_site(from_scratch=args['--from-scratch'], jobs=jobs, optimize=optimize)
+    finally:
+      if profile.active is not None:
+        profile.active.report()
+        profile.active.write_trace(args['--profile'])
 
   elif args['serve']:
 
+    session = Session()
+
     # Build  once
-    try_build_site(from_scratch=args['--from-scratch'])
+    try_build_site(from_scratch=args['--from-scratch'], jobs=jobs, optimize=optimize, session=session)
     # Start webserver
-    process = subprocess.Popen(['python3', '-m', 'http.server'], cwd=build_target)
-    # Kill webserver on program exit
-    atexit.register(lambda: process.kill())
+    from py.serve import start_server
+    notify_reload = start_server(
+      build_target,
+      port=int(args['--port']),
+      live_reload=args['--live-reload'],
+    )
 
     # Rebuild on change:
 
-    def event_handler(event):
+    # Files and directories which builds write to, outside of the build target
+    written_by_builds = [artifact_store_dir, deploy_state_dir]
+    if args['--events']:
+      written_by_builds.append(args['--events'])
+
+    def is_relevant(event):
+      # if the event is just that a file was read (e.g. by us, when syncing), ignore
+      if event.event_type in ('opened', 'closed_no_write'): return False
       # if the event was in the build target directory, ignore
-      if path_in_eq_dir(event.src_path, build_target): return
+      if path_in_eq_dir(event.src_path, build_target): return False
+      # likewise if it was in anything else that building writes to
+      if any(path_in_eq_dir(event.src_path, path) for path in written_by_builds): return False
       # if the event was us modifying /this/ file, ignore
       # since building again wouldn't be using the updated code
-      if Path(event.src_path) == Path(__file__): return
+      if Path(event.src_path) == Path(__file__): return False
       # if the event is just that the top directory was modified, ignore
-      if event.src_path == '.': return
-      # otherwise, rebuild
-      try_build_site(from_scratch=False)
+      if event.src_path == '.': return False
+      return True
+
+    def event_handler(events):
+      # Bursts of events are merged by watch_dir, so
+      # this rebuilds at most once per burst
+      if any(is_relevant(event) for event in events):
+        if try_build_site(from_scratch=False, jobs=jobs, optimize=optimize, session=session):
+          notify_reload()
 
     watch_dir('.', event_handler)
 
+  elif args['deploy']:
+    deploy(
+      args['<destination>'],
+      batch_size=int(args['--batch-size']),
+      dry_run=args['--dry-run'],
+      force=args['--force'],
+    )
+
+  elif args['cache']:
+    store = default_store()
+    if args['stats']:
+      stats = store.stats()
+      print(f"{store.path}: {stats['entries']} artifact(s), {format_size(stats['size'])}")
+      if stats['entries']:
+        print(f"least recently used {time.ctime(stats['oldest_use'])}, most recently {time.ctime(stats['newest_use'])}")
+    elif args['prune']:
+      max_size = parse_size(args['--max-size'] or artifact_store_max_size)
+      removed, removed_size = store.prune(max_size)
+      print(f"Evicted {removed} artifact(s), {format_size(removed_size)}")
+
   elif args['unindexed']:
-    items = find_items(build_source)
+    # Items are parsed relative to the build directory, so bring that up to date first
+    build_target.mkdir(parents=True, exist_ok=True)
+    sync_tree(build_source, build_target, manifest_f=sync_manifest_f)
+    items = find_items(build_target)
     unindexed = [item for item in items if not item['indexed']]
-    locations = [str(item['location']) for item in items]
+    locations = [str(item['location'].relative_to(build_target)) for item in unindexed]
     print('\n'.join(locations))
 
 
@@ -1,4 +1,7 @@
+import functools
 import unplate
+from py.assets import asset_url, optimization_key
+from py.tags import tag_href
 
 if unplate.true:
   exec(unplate.compile(__file__), locals(), globals())
@@ -20,11 +23,11 @@ else:
         <title>{{ title }}</title>
         <meta name="viewport" content="width=device-width, initial-scale=1"/>
         <link rel="stylesheet" type="text/css" href="https://necolas.github.io/normalize.css/8.0.1/normalize.css">
-        <link rel="stylesheet" type="text/css" href="/assets/css/global.css">
+        <link rel="stylesheet" type="text/css" href="{{ asset_url('/assets/css/global.css') }}">
         <!--
           <link rel="stylesheet" type="text/css" media="only screen and (min-device-width: 480px)" href="/assets/css/global-mobile.css">
         -->
-        <link rel="icon" href="/assets/favicon.ico" type="image/x-icon">
+        <link rel="icon" href="{{ asset_url('/assets/favicon.ico') }}" type="image/x-icon">
         {{ head }}
       </head>
       <body>
@@ -33,7 +36,7 @@ else:
             <p class="\header\title">
               Maynard's Site
               &nbsp;
-              <img src="/assets/favicon.ico" />
+              <img src="{{ asset_url('/assets/favicon.ico') }}" />
               &nbsp;
             </p>
             <a href="/">Index</a>
@@ -49,6 +52,12 @@ else:
     return template
 
   def tmpl_requires(requires):
+    # `requires` is usually a list, which can't be used as a cache key
+    return tmpl_requires_cached(tuple(requires), optimization_key())
+
+  # Rendered once per distinct `requires` and set of asset URLs
+  @functools.lru_cache(maxsize=None)
+  def tmpl_requires_cached(requires, key):
     [unplate.begin(template)] @ r"""
     >>> if 'mathjax' in requires:
       <script src="https://cdnjs.cloudflare.com/ajax/libs/mathjax/2.7.5/MathJax.js?config=TeX-MML-AM_CHTML" async></script>
@@ -64,9 +73,9 @@ else:
 
     >>> if 'notes' in requires:
       <script src="https://unpkg.com/hybrids@2.0.2/dist/hybrids.js"></script>
-      <script src="/assets/notes/notes.js"></script>
-      <script src="/assets/notes/linewrap.js"></script>
-      <link rel="stylesheet" type="text/css" href="/assets/notes/notes.css">
+      <script src="{{ asset_url('/assets/notes/notes.js') }}"></script>
+      <script src="{{ asset_url('/assets/notes/linewrap.js') }}"></script>
+      <link rel="stylesheet" type="text/css" href="{{ asset_url('/assets/notes/notes.css') }}">
     <<<
 
     >>> if 'syntax-highlighting' in requires:
@@ -96,6 +105,13 @@ else:
 
     [unplate.begin(body)] @ """
     <h2>{{ item['title'] }}</h2>
+    >>> if item['tags']:
+      <p>
+        >>> for tag in item['tags']:
+          <a href="{{ tag_href(tag) }}" class="tag --plain-link">{{ tag }}</a>
+        <<<
+      </p>
+    <<<
     {{ item['payload'] }}
     """ [unplate.end]
 
@@ -139,3 +155,27 @@ else:
     """ [unplate.end]
 
     return tmpl_base(body, head)
+
+  def tmpl_tag(tag, items):
+    # Page listing the items with a tag; see py/tags.py.
+    # Unlike on the index, items aren't wholly links, since links can't contain the tags' links
+    title = f"Tagged '{tag}'"
+
+    [unplate.begin(body)] @ """
+    <h2>Items tagged <span class="\item\tag tag">{{ tag }}</span></h2>
+    <p><a href="/">Back to the index</a></p>
+    >>> for item in items:
+      <div class="\item">
+        <div class="\item\title-and-tags">
+          <h3 class="\item\title"><a href="{{ item['href'] }}">{{ item['title'] }}</a></h3>
+          >>> for item_tag in item['tags']:
+            <a href="{{ tag_href(item_tag) }}" class="\item\tag tag --plain-link">{{ item_tag }}</a>
+          <<<
+        </div>
+
+        <p class="\item\description">{{ item['description'] }}</p>
+      </div>
+    <<<
+    """ [unplate.end]
+
+    return tmpl_base(body, '', title)
@@ -9,5 +9,5 @@ if [ "$1" = "--build" ]; then
   pipenv run python3 site.py build --from-scratch
 fi
 
-# upload
-rsync -rvutP build/* root@167.99.145.139:/var/www/maynards.site/
+# upload; only what changed since the last upload is sent
+pipenv run python3 site.py deploy root@167.99.145.139:/var/www/maynards.site/